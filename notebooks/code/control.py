@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Predictive control of the linear TCLab models with problems built once.
+
+predictive_control() in 06.04-Implementing-Predictive-Control creates the
+objective, the model constraints and a new cp.Problem from dictionaries of
+scalar variables on every call, so cvxpy canonicalizes the whole problem
+again at each sample. PredictiveController builds the problem once from
+stacked matrix variables with the initial state, setpoint and ambient
+temperature as cp.Parameters, so the problem is DPP compliant and later
+solves only substitute the new parameter values. The QP is handed to OSQP,
+which keeps its factorization between samples and is warm started from the
+previous solution shifted forward one step.
+
+For small models the same problem, with the inputs held over a few blocks
+of the horizon, can be solved offline for all states, setpoints and ambient
+temperatures in a region. compile_explicit() stores the resulting piecewise
+affine control law, which explicit_control() evaluates without a solver.
+CondensedController eliminates the states with prediction matrices cached
+for each model, time step and horizon, and solves the remaining dense QP in
+the inputs alone.
+
+    >>> import sys; sys.path.append('code')
+    >>> from control import predictive_control
+    >>> controller = predictive_control(t_horizon=300, dt=2)
+    >>> U1 = next(controller)
+    >>> U1 = controller.send([SP, Th, Ts, Tamb])
+"""
+
+import numpy as np
+import cvxpy as cp
+import osqp
+import scipy.sparse as sparse
+
+from statespace import LTIModel
+
+# single heater model of 06.04
+alpha = 0.00016       # watts / (units P * percent U1)
+P1 = 200              # P units
+Ua = 0.050            # heat transfer coefficient from heater to environment
+CpH = 2.2             # heat capacity of the heater (J/deg C)
+CpS = 1.9             # heat capacity of the sensor (J/deg C)
+Ub = 0.021            # heat transfer coefficient from heater to sensor
+
+HEATER = LTIModel(A=[[-(Ua + Ub)/CpH, Ub/CpH], [Ub/CpS, -Ub/CpS]],
+                  Bu=[[alpha*P1/CpH], [0]],
+                  Bd=[[Ua/CpH], [0]],
+                  C=[[0, 1]])
+
+# region of (Th, Ts, SP, Tamb) covered by explicit laws of the heater model
+REGION = ([10, 10, 20, 10], [110, 110, 80, 40])
+
+
+def csc_matrix(M):
+    """Return M as a CSC matrix with the index type OSQP expects"""
+    M = sparse.csc_matrix(M)
+    return sparse.csc_matrix((M.data, M.indices.astype(np.int32),
+                              M.indptr.astype(np.int32)), shape=M.shape)
+
+
+def move_blocks(n, moves):
+    """Return the lengths of input blocks covering n steps
+
+    The blocks grow geometrically, so the inputs can change at every step
+    near the start of the horizon and are held over long blocks later.
+    """
+    moves = min(moves, n)
+    edges = [0]
+    for i, edge in enumerate(np.geomspace(1, n + 1, moves + 1)[1:] - 1, 1):
+        edges.append(min(max(round(edge), edges[-1] + 1), n - moves + i))
+    return np.diff(edges)
+
+
+def blocking_matrix(blocks, m=1):
+    """Return T with u = T v expanding one input v per block to every step"""
+    T = np.repeat(np.eye(len(blocks)), blocks, axis=0)
+    return np.kron(T, np.eye(m))
+
+
+_predictions = {}
+
+
+def prediction_matrices(model, dt, n):
+    """Return (Phi, Gu, Gd) with the states x[1..n] = Phi x0 + Gu u + Gd d
+
+    The states, inputs u[0..n-1] and disturbances d[0..n-1] are stacked one
+    step after another. The matrices are computed once for each model, time
+    step and horizon; the cached arrays are shared and must not be modified.
+    """
+    key = (model.A.shape, model.A.tobytes(), model.Bu.tobytes(),
+           model.Bd.tobytes(), round(dt, 9), n)
+    if key not in _predictions:
+        Ad, Bud, Bdd = model.discretize(dt)
+        powers = [np.eye(model.n)]
+        for k in range(n):
+            powers.append(Ad @ powers[-1])
+        powers = np.array(powers)
+        # block (k, j) holds Ad^(k - j) B below the diagonal, zero above
+        lag = np.subtract.outer(np.arange(n), np.arange(n))
+        below = (lag >= 0)[:, :, None, None]
+        blocks = []
+        for B in (Bud, Bdd):
+            markov = np.concatenate([powers[:n] @ B, np.zeros((1,) + B.shape)])
+            G = np.where(below, markov[np.where(lag >= 0, lag, n)], 0)
+            blocks.append(G.transpose(0, 2, 1, 3).reshape(n*model.n,
+                                                          n*B.shape[1]))
+        _predictions[key] = np.vstack(powers[1:]), blocks[0], blocks[1]
+    return _predictions[key]
+
+
+def condense(model, dt, n, blocks=None):
+    """Return (H, F) with the tracking errors y[1..n] - SP = H v + F theta
+
+    The states are eliminated with prediction_matrices(), leaving the
+    inputs v, one for each step or for each block of steps, and the
+    parameters theta = (x0, SP, d), with SP and d constant over the horizon.
+    """
+    q = model.C.shape[0]
+    Phi, Gu, Gd = prediction_matrices(model, dt, n)
+    C = np.kron(np.eye(n), model.C)
+    H = C @ Gu
+    if blocks is not None:
+        H = H @ blocking_matrix(blocks, model.m)
+    F = np.hstack([C @ Phi, -np.kron(np.ones((n, 1)), np.eye(q)),
+                   C @ Gd @ np.kron(np.ones((n, 1)), np.eye(model.p))])
+    return H, F
+
+
+class PredictiveController:
+    """Least squares setpoint tracking MPC built once as a parametrized QP
+
+    Minimizes the squared deviation of the outputs from the setpoint over
+    the horizon subject to the exactly discretized model and bounds on the
+    inputs, as in 06.04.
+    """
+    def __init__(self, model=HEATER, t_horizon=300, dt=2, umin=0, umax=100,
+                 options=None, moves=None):
+        """
+        model: an LTIModel, by default the single heater model of 06.04
+        t_horizon: length of the prediction horizon in seconds
+        dt: time step of the prediction, normally the control period
+        umin, umax: input bounds
+        options: OSQP settings replacing the cvxpy defaults used here, for
+                 example dict(eps_abs=1e-4, eps_rel=1e-4) for faster solves
+        moves: number of intervals of a grid that is fine near the present
+               and coarse later, see move_blocks(). The input is held over
+               each interval and each squared error is weighted by the
+               length of its interval. By default the grid has a step of dt.
+        """
+        self.model = model
+        self.dt = dt
+        steps = round(t_horizon/dt)
+        if moves is None:
+            self.blocks = np.ones(steps, dtype=int)
+        else:
+            self.blocks = move_blocks(steps, moves)
+        self.n = n = len(self.blocks)
+        self.t_grid = dt*np.concatenate([[0], np.cumsum(self.blocks)])
+        q = model.C.shape[0]
+
+        self.x0 = cp.Parameter(model.n, name='x0')
+        self.SP = cp.Parameter(q, name='SP')
+        self.d = cp.Parameter(model.p, name='d')
+        self.x = cp.Variable((model.n, n + 1), name='x')
+        self.u = cp.Variable((model.m, n), name='u')
+        self.y = model.C @ self.x
+
+        constraints = [self.x[:, 0] == self.x0]
+        # the intervals of each length share one exact discretization
+        for length in np.unique(self.blocks):
+            k = np.flatnonzero(self.blocks == length)
+            Ad, Bud, Bdd = model.discretize(length*dt)
+            w = (cp.reshape(Bdd @ self.d, (model.n, 1), order='F') @
+                 np.ones((1, len(k))))
+            constraints.append(self.x[:, k + 1] ==
+                               Ad @ self.x[:, k] + Bud @ self.u[:, k] + w)
+        constraints += [self.u >= umin, self.u <= umax]
+        reference = cp.reshape(self.SP, (q, 1), order='F') @ np.ones((1, n))
+        tracking = self.y[:, 1:] - reference
+        weights = np.sqrt(self.blocks)
+        objective = cp.sum_squares(tracking @ np.diag(weights))
+        self.problem = cp.Problem(cp.Minimize(objective), constraints)
+        # columns holding the solution one control period later
+        self.nodes = np.searchsorted(self.t_grid, self.t_grid + dt,
+                                     side='right') - 1
+        self.intervals = np.minimum(self.nodes[:-1], n - 1)
+        self.options = dict(eps_abs=1e-5, eps_rel=1e-5, max_iter=10000,
+                            polishing=True, verbose=False)
+        self.options.update(options or {})
+        self.solver = None
+        self.solution = None
+
+    def layout(self, inverse_data):
+        """Return the (offset, shape) blocks of the solver's primal and dual
+        vectors, found in the inverse data of the last reduction"""
+        from cvxpy.constraints import Equality, Zero
+
+        for data in reversed(inverse_data):
+            if getattr(data, 'constraints', None) is not None:
+                primal = [(data.var_offsets[i], data.var_shapes[i])
+                          for i in data.var_offsets]
+                # OSQP rows hold the equality constraints, then the others
+                dual = []
+                offset = 0
+                for equality in (True, False):
+                    for con in data.constraints:
+                        if isinstance(con, (Equality, Zero)) == equality:
+                            dual.append((offset, con.shape))
+                            offset += con.size
+                return primal, dual
+        return [], []
+
+    def shift(self, z, blocks):
+        """Advance a solution vector by one time step to warm start the next"""
+        z = z.copy()
+        for offset, shape in blocks:
+            if len(shape) == 2 and shape[1] in (self.n, self.n + 1):
+                if shape[1] == self.n + 1:
+                    columns = self.nodes
+                else:
+                    columns = self.intervals
+                size = shape[0]*shape[1]
+                block = z[offset:offset + size].reshape(shape, order='F')
+                z[offset:offset + size] = block[:, columns].ravel(order='F')
+        return z
+
+    def solve(self, x0, SP, d=()):
+        """Solve for the inputs over the horizon from state x0
+
+        Returns the (m, n) array of optimal inputs, or None if the solver
+        failed.
+        """
+        self.x0.value = np.asarray(x0, dtype=float).reshape(-1)
+        self.SP.value = np.broadcast_to(np.asarray(SP, dtype=float),
+                                        self.SP.shape)
+        if self.model.p:
+            self.d.value = np.asarray(d, dtype=float).reshape(-1)
+        data, chain, inverse_data = self.problem.get_problem_data(cp.OSQP)
+        upper = np.concatenate([data['b'], data['G']])
+        lower = np.concatenate([data['b'], np.full(len(data['G']), -np.inf)])
+        if self.solver is None:
+            # the parameters appear only in q, l and u, so P and A are
+            # factorized once
+            self.solver = osqp.OSQP()
+            P = csc_matrix(data['P'])
+            A = csc_matrix(sparse.vstack([data['A'], data['F']]))
+            self.solver.setup(P, data['q'], A, lower, upper, **self.options)
+            self.primal, self.dual = self.layout(inverse_data)
+        else:
+            self.solver.update(q=data['q'], l=lower, u=upper)
+            if self.solution is not None:
+                self.solver.warm_start(
+                    x=self.shift(self.solution.x, self.primal),
+                    y=self.shift(self.solution.y, self.dual))
+        results = self.solver.solve()
+        self.problem.unpack_results(results, chain, inverse_data)
+        if self.problem.status not in ('optimal', 'optimal_inaccurate'):
+            self.solution = None
+            return None
+        self.solution = results
+        return self.u.value
+
+
+def predictive_control(t_horizon=300, dt=2, model=HEATER, **kwargs):
+    """Generator with the interface of predictive_control() in 06.04
+
+    Receives [SP, Th, Ts, Tamb] and yields the heater input MV. kwargs are
+    passed to PredictiveController.
+    """
+    controller = PredictiveController(model, t_horizon, dt, **kwargs)
+    MV = 0
+    while True:
+        SP, Th, Ts, Tamb = yield MV
+        u = controller.solve([Th, Ts], SP, [Tamb])
+        if u is not None:
+            MV = u[0, 0]
+
+
+class CondensedController:
+    """Setpoint tracking MPC of 06.04 solved as a dense QP in the inputs
+
+    The states over the horizon are linear in the initial state, the inputs
+    and the disturbances, so substituting them leaves a QP with only the
+    inputs as variables and the input bounds as constraints. Its Hessian is
+    fixed and only the linear term, a matrix product with the parameters
+    (x0, SP, d), changes between samples, so OSQP factorizes once and each
+    solve is warm started from the previous inputs shifted one step.
+    """
+    def __init__(self, model=HEATER, t_horizon=300, dt=2, umin=0, umax=100,
+                 options=None, moves=None):
+        """
+        model: an LTIModel, by default the single heater model of 06.04
+        t_horizon: length of the prediction horizon in seconds
+        dt: time step of the prediction, normally the control period
+        umin, umax: input bounds
+        options: OSQP settings replacing the defaults used here
+        moves: if given, hold the inputs over move_blocks(n, moves) of the
+               grid with a step of dt
+        """
+        self.model = model
+        self.dt = dt
+        self.steps = n = round(t_horizon/dt)
+        if moves is None:
+            self.blocks = np.ones(n, dtype=int)
+        else:
+            self.blocks = move_blocks(n, moves)
+        H, F = condense(model, dt, n, self.blocks)
+        self.T = blocking_matrix(self.blocks, model.m)
+        self.Fq = 2*H.T @ F
+        nv = H.shape[1]
+        nb = len(self.blocks)
+        lower = np.tile(np.broadcast_to(umin, (model.m,)), nb).astype(float)
+        upper = np.tile(np.broadcast_to(umax, (model.m,)), nb).astype(float)
+        # polishing rarely finds a better point on this flat objective and
+        # OSQP reports each time it finds no active bound
+        self.options = dict(eps_abs=1e-5, eps_rel=1e-5, max_iter=10000,
+                            polishing=False, verbose=False)
+        self.options.update(options or {})
+        self.solver = osqp.OSQP()
+        self.solver.setup(csc_matrix(sparse.triu(2*H.T @ H)), np.zeros(nv),
+                          csc_matrix(sparse.eye(nv)), lower, upper,
+                          **self.options)
+        # inputs one step later for the warm start
+        edges = np.concatenate([[0], np.cumsum(self.blocks)])
+        later = np.minimum(edges[:-1] + 1, n - 1)
+        blocks = np.searchsorted(edges, later, side='right') - 1
+        self.later = (model.m*blocks[:, None] + np.arange(model.m)).ravel()
+        self.solution = None
+
+    def solve(self, x0, SP, d=()):
+        """Solve for the inputs over the horizon from state x0
+
+        Returns the (m, n) array of optimal inputs, or None if the solver
+        failed.
+        """
+        theta = np.concatenate([np.asarray(x0, dtype=float).reshape(-1),
+                                np.broadcast_to(np.asarray(SP, dtype=float),
+                                                (self.model.C.shape[0],)),
+                                np.asarray(d, dtype=float).reshape(-1)])
+        self.solver.update(q=self.Fq @ theta)
+        if self.solution is not None:
+            x, y = self.solution
+            self.solver.warm_start(x=x[self.later], y=y[self.later])
+        results = self.solver.solve()
+        if results.info.status not in ('solved', 'solved inaccurate'):
+            self.solution = None
+            return None
+        self.solution = results.x, results.y
+        return (self.T @ results.x).reshape(self.steps, self.model.m).T
+
+
+def condensed_control(t_horizon=300, dt=2, model=HEATER, **kwargs):
+    """Generator with the interface of predictive_control() in 06.04
+
+    Receives [SP, Th, Ts, Tamb] and yields the heater input MV computed by
+    a CondensedController. kwargs are passed to CondensedController.
+    """
+    controller = CondensedController(model, t_horizon, dt, **kwargs)
+    MV = 0
+    while True:
+        SP, Th, Ts, Tamb = yield MV
+        u = controller.solve([Th, Ts], SP, [Tamb])
+        if u is not None:
+            MV = u[0, 0]
+
+
+def blocking_tradeoff(moves=(None, 40, 20, 10, 5), t_final=600, dt=2,
+                      t_horizon=300, model=HEATER, setpoints=(50, 35),
+                      d=(21,)):
+    """Compare closed loop simulations with fine and blocked horizons
+
+    The model is controlled from rest at the ambient temperature through
+    steps in the setpoint at equal intervals. Returns a list with, for each
+    value of moves passed to PredictiveController, the number of
+    intervals, the number of decision variables, the mean solve time in ms
+    and the integral of the squared tracking error (ISE).
+    """
+    import time
+
+    steps = round(t_final/dt)
+    SP = np.repeat(setpoints, -(-steps//len(setpoints)))[:steps]
+    results = []
+    for value in moves:
+        controller = PredictiveController(model, t_horizon, dt, moves=value)
+        x = np.linalg.solve(model.A, -model.Bd @ np.asarray(d, dtype=float))
+        ise = 0
+        start = time.perf_counter()
+        for k in range(steps):
+            u = controller.solve(x, SP[k], d)
+            x = model.step(x, u[:, 0], d, dt)
+            ise += dt*np.sum((model.output(x) - SP[k])**2)
+        elapsed = time.perf_counter() - start
+        size = controller.problem.size_metrics
+        results.append(dict(moves=value, intervals=controller.n,
+                            variables=size.num_scalar_variables,
+                            ms=1000*elapsed/steps, ISE=float(ise)))
+    return results
+
+
+class ExplicitMPC:
+    """Piecewise affine control law of a box constrained least squares MPC
+
+    The problem minimizes ||H v + F theta||^2 subject to lower <= v <= upper
+    for a parameter vector theta. Each optimal active set is valid over a
+    polyhedral region of theta, in which the solution is an affine function
+    of theta given by the KKT conditions. Regions are found by solving the
+    problem at sampled parameters in a box, and only the halfspaces and the
+    law of the first move are kept. A grid over the box lists the regions
+    met in each cell, so a lookup checks the last region, then those of the
+    cell, then all regions. Parameters outside every known region are solved
+    online and their region is added, so the law is exact wherever it is
+    used.
+    """
+    def __init__(self, H, F, lower, upper, bounds, m=1, cells=8, tol=1e-8):
+        """
+        H, F: matrices of the least squares objective
+        lower, upper: bounds of the decision variables v
+        bounds: (lower, upper) corners of the box of parameters explored
+        m: number of leading elements of v returned by the law
+        cells: number of grid cells along each parameter in the index
+        tol: tolerance of the region tests
+        """
+        self.H = np.asarray(H, dtype=float)
+        self.F = np.asarray(F, dtype=float)
+        nv = self.H.shape[1]
+        self.lower = np.broadcast_to(lower, (nv,)).astype(float)
+        self.upper = np.broadcast_to(upper, (nv,)).astype(float)
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.m = m
+        self.cells = cells
+        self.tol = tol
+        self.P = self.H.T @ self.H
+        self.Fq = self.H.T @ self.F
+        self.G = np.vstack([np.eye(nv), -np.eye(nv)])
+        self.w = np.concatenate([self.upper, -self.lower])
+        self.regions = []      # (halfspaces, limits, gain, offset, active)
+        self.index = {}
+        self.last = None
+
+    def law(self, active):
+        """Return (K, k, L, l) with v = K theta + k and the multipliers of
+        the active constraints L theta + l"""
+        G, w = self.G[active], self.w[active]
+        Pinv_G = np.linalg.solve(self.P, G.T)
+        Pinv_F = np.linalg.solve(self.P, self.Fq)
+        if len(active):
+            M = G @ Pinv_G
+            L = -np.linalg.solve(M, G @ Pinv_F)
+            l = -np.linalg.solve(M, w)
+        else:
+            L = np.zeros((0, self.F.shape[1]))
+            l = np.zeros(0)
+        return -Pinv_F - Pinv_G @ L, -Pinv_G @ l, L, l
+
+    def solve(self, theta):
+        """Return the optimal active set at theta as a sorted list of rows"""
+        from scipy.optimize import lsq_linear
+
+        nv = len(self.lower)
+        v = lsq_linear(self.H, -self.F @ theta,
+                       bounds=(self.lower, self.upper), method='bvls').x
+        scale = 1e-6*np.maximum(1, self.upper - self.lower)
+        active = ([i for i in range(nv)
+                   if v[i] > self.upper[i] - scale[i]] +
+                  [nv + i for i in range(nv)
+                   if v[i] < self.lower[i] + scale[i]])
+        # correct the active set left by the solver's tolerances
+        for iteration in range(4*nv):
+            K, k, L, l = self.law(active)
+            multipliers = L @ theta + l
+            violation = self.G @ (K @ theta + k) - self.w
+            violation[active] = -np.inf
+            if len(active) and multipliers.min() < -self.tol:
+                active.pop(int(multipliers.argmin()))
+            elif violation.max() > self.tol:
+                active = sorted(active + [int(violation.argmax())])
+            else:
+                break
+        return active
+
+    def cell(self, theta):
+        """Return the index of the grid cell holding theta"""
+        lo, hi = self.bounds
+        i = np.floor((theta - lo)/(hi - lo)*self.cells).astype(int)
+        return tuple(np.clip(i, 0, self.cells - 1))
+
+    def add(self, active):
+        """Add the region of an active set and return its number"""
+        K, k, L, l = self.law(active)
+        inactive = np.setdiff1d(np.arange(len(self.w)), active)
+        G = self.G[inactive]
+        halfspaces = np.vstack([G @ K, -L])
+        limits = np.concatenate([self.w[inactive] - G @ k, l])
+        # drop rows that do not depend on theta and always hold
+        keep = (np.abs(halfspaces).max(axis=1) > 1e-12) | (limits < 0)
+        self.regions.append((halfspaces[keep], limits[keep], K[:self.m],
+                             k[:self.m], np.asarray(active, dtype=int)))
+        return len(self.regions) - 1
+
+    def contains(self, r, theta):
+        """Return True if region r holds theta"""
+        halfspaces, limits = self.regions[r][:2]
+        return (halfspaces @ theta <= limits + self.tol).all()
+
+    def locate(self, theta, explore=True):
+        """Return the number of the region holding theta
+
+        If no known region holds theta and explore is True, the problem is
+        solved at theta and its region added, otherwise None is returned.
+        """
+        if self.last is not None and self.contains(self.last, theta):
+            return self.last
+        cell = self.cell(theta)
+        candidates = self.index.get(cell, [])
+        for r in candidates:
+            if self.contains(r, theta):
+                self.last = r
+                return r
+        for r in range(len(self.regions)):
+            if r not in candidates and self.contains(r, theta):
+                break
+        else:
+            if not explore:
+                return None
+            r = self.add(self.solve(theta))
+        self.index.setdefault(cell, []).append(r)
+        self.last = r
+        return r
+
+    def explore(self, samples=1000, max_regions=5000, seed=0):
+        """Find the regions met by random parameters in the box
+
+        Batches of samples are drawn until a batch finds no new region or
+        max_regions are known. Returns the number of regions.
+        """
+        rng = np.random.default_rng(seed)
+        lo, hi = self.bounds
+        while len(self.regions) < max_regions:
+            known = len(self.regions)
+            for theta in lo + (hi - lo)*rng.random((samples, len(lo))):
+                self.locate(theta)
+            if len(self.regions) == known:
+                break
+        return len(self.regions)
+
+    def __call__(self, theta):
+        """Return the first move of the optimal inputs at parameters theta"""
+        theta = np.asarray(theta, dtype=float)
+        gain, offset = self.regions[self.locate(theta)][2:4]
+        return gain @ theta + offset
+
+    def save(self, path):
+        """Save the problem and the regions found to a .npz file"""
+        arrays = dict(H=self.H, F=self.F, lower=self.lower, upper=self.upper,
+                      bounds=self.bounds, m=self.m, cells=self.cells,
+                      tol=self.tol)
+        for r, region in enumerate(self.regions):
+            arrays[f'active{r}'] = region[4]
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Return an ExplicitMPC saved with save()"""
+        data = np.load(path)
+        law = cls(data['H'], data['F'], data['lower'], data['upper'],
+                  data['bounds'], int(data['m']), int(data['cells']),
+                  float(data['tol']))
+        r = 0
+        while f'active{r}' in data:
+            law.add(list(data[f'active{r}']))
+            r += 1
+        return law
+
+
+def compile_explicit(model=HEATER, t_horizon=300, dt=2, umin=0, umax=100,
+                     moves=8, bounds=REGION, **kwargs):
+    """Return the ExplicitMPC of the setpoint tracking problem of 06.04
+
+    The parameters are theta = (x0, SP, d), (Th, Ts, SP, Tamb) for the
+    heater model, with the disturbances constant over the horizon. The
+    inputs are held over move_blocks(n, moves) so that the number of regions
+    stays small; with a move at every step the law has too many regions to
+    be worth storing.
+
+    model: an LTIModel, by default the single heater model of 06.04
+    t_horizon: length of the prediction horizon in seconds
+    dt: time step of the prediction, normally the control period
+    umin, umax: input bounds
+    moves: number of input blocks
+    bounds: (lower, upper) corners of the box of parameters explored
+    kwargs: passed to ExplicitMPC.explore
+    """
+    n = round(t_horizon/dt)
+    H, F = condense(model, dt, n, move_blocks(n, moves))
+    law = ExplicitMPC(H, F, umin, umax, bounds, model.m)
+    law.explore(**kwargs)
+    return law
+
+
+def explicit_control(t_horizon=300, dt=2, model=HEATER, law=None, **kwargs):
+    """Generator with the interface of predictive_control() in 06.04
+
+    Receives [SP, Th, Ts, Tamb] and yields the heater input MV from an
+    explicit law, by default compiled with compile_explicit(). kwargs are
+    passed to compile_explicit().
+    """
+    if law is None:
+        law = compile_explicit(model, t_horizon, dt, **kwargs)
+    MV = 0
+    while True:
+        SP, Th, Ts, Tamb = yield MV
+        MV = law(np.array([Th, Ts, SP, Tamb]))[0]
@@ -0,0 +1,671 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""State estimation for many similar units using the models in statespace.py.
+
+    >>> import sys; sys.path.append('code')
+    >>> from statespace import LTIModel
+    >>> from estimation import BatchObserver, replay
+    >>> obs = BatchObserver(LTIModel(A, Bu, Bd, C), L, x_initial, d_initial, units=200)
+    >>> x_hat, y_err = obs.update(t, U, Y)       # U is (200, m), Y is (200, q)
+
+Recorded experiments can be replayed through an observer without the
+simulator or plotter:
+
+    >>> result = replay('data/tclab-data.csv', BatchObserver(model, L, x_initial, d_initial))
+    >>> plt.plot(result['Time'], result['y_err'][:, 0, 0])
+
+and candidate observer gains ranked against a recording:
+
+    >>> ranking = sweep(model, 'data/tclab-data.csv', x_initial, d_initial,
+    ...                 multipliers=[2, 3, 5], gammas=[1/20, 1/10])
+    >>> L = ranking[0]['L']
+
+Faults show up in the prediction errors of an observer, which a
+ResidualDetector watches sample by sample:
+
+    >>> detector = ResidualDetector(q=2, historian=h)
+    >>> x_hat, y_err = observer.send([t, u, y])
+    >>> alarm = detector.update(t, y_err)
+
+For noisy sensors kalman_filter() is a drop-in replacement for the observer
+generators with the gain computed from noise covariances rather than tuned
+by hand:
+
+    >>> observer = kalman_filter(model, Q=0.01*np.eye(4), R=0.1*np.eye(2),
+    ...                          x_initial=x_initial, d_hat=d_initial)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.linalg import expm, solve_discrete_are, solve_discrete_lyapunov
+from scipy.signal import place_poles
+from scipy.stats import chi2
+
+import historian
+from statespace import LTIModel
+
+
+class BatchObserver:
+    """Luenberger observer for N units sharing one linear model
+
+    The state estimates are held in an (N, n) array. Each update computes the
+    corrected states and the output predictions of every unit with a single
+    matrix product of the stacked [x, u, d, y] rows with a matrix built once
+    for each time step from the exact discretization of the model and of the
+    continuous observer dx/dt = (A - LC) x + Bu u + Bd d + L y.
+    """
+    def __init__(self, model, L, x_initial, d_hat=(), units=None):
+        """
+        model: an LTIModel
+        L: (n, q) observer gain
+        x_initial: initial state estimate, (n,) for all units or (N, n)
+        d_hat: disturbance estimate, (p,) for all units or (N, p)
+        units: number of units N, needed if x_initial is one state vector
+        """
+        self.model = model
+        self.L = np.asarray(L, dtype=float).reshape(model.n, -1)
+        self.closed = LTIModel(model.A - self.L @ model.C, model.Bu,
+                               np.hstack([model.Bd, self.L]), model.C)
+        x_initial = np.asarray(x_initial, dtype=float)
+        if units is None:
+            units = len(x_initial) if x_initial.ndim == 2 else 1
+        self.units = units
+        self.x = np.broadcast_to(x_initial, (units, model.n)).copy()
+        d_hat = np.asarray(d_hat, dtype=float)
+        self.d = np.zeros((units, model.p))
+        if model.p:
+            self.d[:] = d_hat.reshape(-1, model.p)
+        self.q = model.C.shape[0]
+        self.y_err = np.full((units, self.q), np.nan)
+        self.t = np.zeros(units)
+        self.matrices = {}
+
+    def matrix(self, dt):
+        """Return M with [x_next, y_pred] = M @ [x, u, d, y] for a time step"""
+        key = round(dt, 9)
+        if key not in self.matrices:
+            n, q = self.model.n, self.q
+            Ad, Bud, Bdd = self.model.discretize(dt)
+            Acl, Bucl, Bwcl = self.closed.discretize(dt)
+            C = self.model.C
+            self.matrices[key] = np.vstack([
+                np.hstack([Acl, Bucl, Bwcl]),
+                np.hstack([C @ Ad, C @ Bud, C @ Bdd, np.zeros((q, q))])])
+        return self.matrices[key]
+
+    def update(self, t, u, y, d=None, units=slice(None)):
+        """Correct the state estimates with new measurements
+
+        t: time of the measurements, a scalar or one value per unit
+        u: (N, m) inputs applied since the last update
+        y: (N, q) measurements
+        d: (N, p) disturbance estimates, by default the current ones
+        units: index or mask selecting the units being updated, by default all
+
+        Returns the (N, n) state estimates and the (N, q) prediction errors
+        y_pred - y of the selected units.
+        """
+        rows = np.atleast_1d(np.arange(self.units)[units])
+        t = np.broadcast_to(np.asarray(t, dtype=float), rows.shape)
+        u = np.asarray(u, dtype=float).reshape(len(rows), -1)
+        y = np.asarray(y, dtype=float).reshape(len(rows), -1)
+        if d is not None:
+            self.d[rows] = np.asarray(d, dtype=float).reshape(len(rows), -1)
+        z = np.hstack([self.x[rows], u, self.d[rows], y])
+        dt = t - self.t[rows]
+        n = self.model.n
+        for step in np.unique(dt):
+            sel = dt == step
+            w = z[sel] @ self.matrix(step).T
+            self.x[rows[sel]] = w[:, :n]
+            self.y_err[rows[sel]] = w[:, n:] - y[sel]
+        self.t[rows] = t
+        return self.x[rows], self.y_err[rows]
+
+    def unit(self, i):
+        """Generator for unit i with the send([t, u, y]) protocol of
+        tclab_observer(), updating row i of the shared state array"""
+        y_err = None
+        while True:
+            t, u, y = yield self.x[i].copy(), y_err
+            x, y_err = self.update(t, [u], [y], units=[i])
+            y_err = y_err[0]
+
+
+def load(source, session=None, tags=None):
+    """Read a recorded experiment into a dictionary of arrays
+
+    source: a historian CSV file, an Arrow or Parquet log written by
+            Historian.to_arrow() or to_parquet(), a Historian, a pandas
+            DataFrame, or a dictionary of arrays
+    session: session id when source is a Historian, by default the current
+    tags: list of tags to read, by default all
+
+    Returns a dictionary of NumPy arrays keyed by 'Time' and tag name.
+    """
+    if isinstance(source, str):
+        if source.endswith(('.arrow', '.feather', '.parquet')):
+            return historian.read_log(source, None if tags is None else
+                                      ['Time'] + list(tags))
+        filename, columns, values = historian._read_csv(source)
+        return dict(zip(columns, values.T))
+    if isinstance(source, historian.Historian):
+        return source.query(session, tags)
+    if hasattr(source, 'columns'):
+        frame = source.reset_index() if 'Time' not in source.columns else source
+        return dict((name, frame[name].to_numpy()) for name in frame.columns)
+    return dict(source)
+
+
+def replay(source, observer, inputs=('Q1', 'Q2'), outputs=('T1', 'T2'),
+           disturbances=None, session=None, resolution=None):
+    """Run an observer over a recorded experiment
+
+    Each row of the recording is sent to the observer as [t, u, y], with the
+    inputs logged at time t taken as those applied since the previous row,
+    as in the experiments of 04.06-Lab-Assignment-Anomaly-Detection.
+
+    source: a recording accepted by load()
+    observer: a generator with the send([t, u, y]) protocol of
+              tclab_observer(), or a BatchObserver. The recording is fed to
+              every unit of a BatchObserver, so several units started from
+              different initial states can be compared in one pass.
+    inputs, outputs: tags holding the inputs u and the measurements y
+    disturbances: tags holding the disturbances d, by default the
+                  observer's own disturbance estimate is used
+    session: session id when source is a Historian
+    resolution: if given, time steps are rounded to a multiple of this many
+                seconds so a BatchObserver computes fewer discretizations
+                when replaying real-time data with jittery sample times
+
+    Returns a dictionary with the arrays 'Time' (K,), 'x_hat' (K, n) and
+    'y_err' (K, q) holding the estimates after each row, with an extra unit
+    axis after the first for a BatchObserver.
+    """
+    tags = list(inputs) + list(outputs) + list(disturbances or [])
+    data = load(source, session, tags)
+    t = np.asarray(data['Time'], dtype=float)
+    u = np.column_stack([data[tag] for tag in inputs]).astype(float)
+    y = np.column_stack([data[tag] for tag in outputs]).astype(float)
+    d = (None if disturbances is None else
+         np.column_stack([data[tag] for tag in disturbances]).astype(float))
+
+    if not isinstance(observer, BatchObserver):
+        next(observer)
+        x_hat, y_err = [], []
+        for k in range(len(t)):
+            x, e = observer.send([t[k], u[k], y[k]])
+            x_hat.append(np.array(x, dtype=float))
+            y_err.append(np.array(e, dtype=float))
+        return {'Time': t, 'x_hat': np.array(x_hat), 'y_err': np.array(y_err)}
+
+    # Everything except the state recursion is computed for all rows at
+    # once, and the recursion runs over each stretch of equal time steps.
+    obs = observer
+    n, m, p = obs.model.n, obs.model.m, obs.model.p
+    N = obs.units
+    dt = np.diff(t, prepend=obs.t[0])
+    if resolution:
+        dt = np.round(dt/resolution)*resolution
+    steps, index = np.unique(dt, return_inverse=True)
+    matrices = [obs.matrix(step) for step in steps]
+    d = obs.d[None] if d is None else d[:, None]
+    w = np.empty((len(t), N, n + obs.q))
+    for j, M in enumerate(matrices):
+        rows = index == j
+        w[rows] = ((u[rows] @ M[:, n:n+m].T + y[rows] @ M[:, n+m+p:].T)[:, None]
+                   + d[rows if len(d) > 1 else slice(None)] @ M[:, n+m:n+m+p].T)
+    x_hat = np.empty((len(t), N, n))
+    x = obs.x
+    starts = np.flatnonzero(np.diff(index, prepend=-1))
+    for start, stop in zip(starts, np.append(starts[1:], len(t))):
+        M = matrices[index[start]]
+        x_hat[start:stop] = _recurrence(M[:n, :n], x, w[start:stop, :, :n])
+        x = x_hat[stop - 1]
+    # predictions use the state before each correction
+    x_prev = np.concatenate([obs.x[None], x_hat[:-1]])
+    y_err = np.empty((len(t), N, obs.q))
+    for j, M in enumerate(matrices):
+        rows = index == j
+        y_err[rows] = x_prev[rows] @ M[n:, :n].T + w[rows, :, n:] - y[rows, None]
+    if len(t):
+        obs.x[:] = x_hat[-1]
+        obs.y_err[:] = y_err[-1]
+        obs.t[:] = t[-1]
+    return {'Time': t, 'x_hat': x_hat, 'y_err': y_err}
+
+
+def _recurrence(A, x0, w, minlength=32):
+    """Return x[k] = A x[k-1] + w[k] for each row of w, starting from x0
+
+    x0 is an (N, n) array of states and w a (K, N, n) array. Long sequences
+    are solved in the modal coordinates of A, where each mode is a scalar
+    first order recursion evaluated by scipy.signal.lfilter.
+    """
+    x = np.empty(w.shape)
+    if len(w) >= minlength:
+        lam, V = np.linalg.eig(A)
+        if np.linalg.cond(V) < 1e8:
+            from scipy.signal import lfilter
+            Vinv = np.linalg.inv(V)
+            if not np.iscomplexobj(lam):
+                V, Vinv = V.real, Vinv.real
+            # one contiguous (N, K) series per mode
+            eta = np.ascontiguousarray(np.moveaxis(w @ Vinv.T, -1, 0).swapaxes(1, 2))
+            xi0 = x0 @ Vinv.T
+            for i, a in enumerate(lam):
+                eta[i] = lfilter([1], [1, -a], eta[i], zi=a*xi0[:, i:i+1])[0]
+            x[:] = (eta.transpose(2, 1, 0) @ V.T).real
+            return x
+    for k in range(len(w)):
+        x0 = x[k] = x0 @ A.T + w[k]
+    return x
+
+
+def pole_placement_gain(A, C, multiplier):
+    """Observer gain placing the poles of A - LC at multiplier times those of A,
+    as in 04.06-Lab-Assignment-Anomaly-Detection"""
+    evals = np.linalg.eigvals(A)
+    return place_poles(A.T, C.T, multiplier*evals).gain_matrix.T
+
+
+# LMI gains by (A, C, gamma), or None if infeasible, shared by all sweeps
+# in a session
+_lmi_gains = {}
+
+
+def lmi_gain(A, C, gamma):
+    """Observer gain with a guaranteed decay rate gamma/2 of the estimation
+    error, from the LMI of 04.07-Observer-Synthesis-LMI
+
+    Results are cached, including failures, so repeated sweeps solve each
+    SDP only once. Raises ValueError if the LMI is infeasible or the solver
+    fails.
+    """
+    A = np.asarray(A, dtype=float)
+    C = np.asarray(C, dtype=float)
+    key = _lmi_key(A, C, gamma)
+    if key not in _lmi_gains:
+        import cvxpy as cp
+
+        n, p = A.shape[0], C.shape[0]
+        P = cp.Variable((n, n), PSD=True)
+        Y = cp.Variable((n, p))
+        constraints = [P >> np.eye(n)]
+        constraints += [A.T@P + P@A - C.T@Y.T - Y@C + gamma*P << 0]
+        prob = cp.Problem(cp.Minimize(0), constraints)
+        try:
+            prob.solve()
+        except cp.error.SolverError:
+            pass
+        if prob.status in ('optimal', 'optimal_inaccurate'):
+            _lmi_gains[key] = np.linalg.inv(P.value) @ Y.value
+        else:
+            _lmi_gains[key] = None
+    if _lmi_gains[key] is None:
+        raise ValueError(f'no observer gain with decay rate gamma={gamma}')
+    return _lmi_gains[key]
+
+
+def candidate_gains(model, multipliers=(), gammas=(), processes=None):
+    """Return a list of (method, parameter, L) observer gain candidates
+
+    Pole placement gains are computed for each multiplier and LMI gains for
+    each decay rate gamma. LMIs not already cached are solved in parallel.
+    Infeasible candidates are left out.
+    """
+    candidates = []
+    for multiplier in multipliers:
+        try:
+            L = pole_placement_gain(model.A, model.C, multiplier)
+        except ValueError:
+            continue
+        candidates.append(('poles', multiplier, L))
+    missing = [gamma for gamma in gammas
+               if _lmi_key(model.A, model.C, gamma) not in _lmi_gains]
+    if len(missing) > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            gains = pool.map(_try_lmi_gain, [model.A]*len(missing),
+                             [model.C]*len(missing), missing)
+            for gamma, L in zip(missing, gains):
+                _lmi_gains[_lmi_key(model.A, model.C, gamma)] = L
+    for gamma in gammas:
+        L = _try_lmi_gain(model.A, model.C, gamma)
+        if L is not None:
+            candidates.append(('lmi', gamma, L))
+    return candidates
+
+
+def _lmi_key(A, C, gamma):
+    return A.shape, A.tobytes(), C.shape, C.tobytes(), float(gamma)
+
+
+def _try_lmi_gain(A, C, gamma):
+    try:
+        return lmi_gain(A, C, gamma)
+    except ValueError:
+        return None
+
+
+def score(model, L, data, x_initial, d_hat=(), inputs=('Q1', 'Q2'),
+          outputs=('T1', 'T2'), offset=5.0, tol=0.05):
+    """Score an observer gain on a recorded experiment
+
+    data: dictionary of arrays as returned by load()
+    x_initial, d_hat: initial state and disturbance estimates
+    offset: size of the initial state error used to measure convergence
+    tol: fraction of the initial error counted as converged
+
+    Returns a dictionary with
+        rms: root mean square of the prediction errors y_pred - y
+        convergence: time after which an estimate started offset degrees
+            away stays within tol*offset of the nominal one
+        noise: RMS of the estimation error caused by unit variance white
+            measurement noise at the median sample interval
+    """
+    x_initial = np.asarray(x_initial, dtype=float)
+    obs = BatchObserver(model, L, [x_initial, x_initial + offset], d_hat)
+    result = replay(data, obs, inputs, outputs)
+    t = result['Time']
+    gap = np.abs(result['x_hat'][:, 1] - result['x_hat'][:, 0]).max(axis=1)
+    unconverged = np.flatnonzero(gap > tol*offset)
+    if len(unconverged) == 0:
+        convergence = t[0]
+    elif unconverged[-1] + 1 < len(t):
+        convergence = t[unconverged[-1] + 1]
+    else:
+        convergence = np.inf
+    dt = np.median(np.diff(t)) if len(t) > 1 else 1.0
+    Acl, Bucl, Bwcl = obs.closed.discretize(dt)
+    Ly = Bwcl[:, model.p:]
+    noise = np.sqrt(np.trace(solve_discrete_lyapunov(Acl, Ly @ Ly.T)))
+    return {'rms': np.sqrt(np.mean(result['y_err'][:, 0]**2)),
+            'convergence': convergence,
+            'noise': noise}
+
+
+# recording and settings shared by the scoring processes of a sweep
+_sweep = {}
+
+
+def _init_sweep(model, data, kwargs):
+    _sweep.update(model=model, data=data, kwargs=kwargs)
+
+
+def _score(L):
+    return score(_sweep['model'], L, _sweep['data'], **_sweep['kwargs'])
+
+
+def sweep(model, source, x_initial, d_hat=(), multipliers=(2, 3, 4, 6, 8),
+          gammas=(1/40, 1/20, 1/10, 1/5), candidates=(), session=None,
+          processes=None, **kwargs):
+    """Rank observer gains by replaying a recorded experiment
+
+    Candidate gains from pole placement multipliers and LMI decay rates, plus
+    any (method, parameter, L) tuples given as candidates, are scored by
+    score() in a pool of processes. The recording is loaded once and sent
+    to each process when it starts.
+
+    source, session: a recording accepted by load()
+    x_initial, d_hat: initial state and disturbance estimates
+    processes: number of worker processes, by default one per CPU
+    kwargs: further arguments for score()
+
+    Returns a list of dictionaries with the method, parameter, gain L and
+    scores of each candidate, sorted by the sum of its ranks for rms,
+    convergence and noise, best first.
+    """
+    data = load(source, session)
+    candidates = list(candidates) + candidate_gains(model, multipliers, gammas,
+                                                    processes)
+    kwargs.update(x_initial=x_initial, d_hat=d_hat)
+    with ProcessPoolExecutor(processes, initializer=_init_sweep,
+                             initargs=(model, data, kwargs)) as pool:
+        scores = list(pool.map(_score, [L for method, parameter, L in candidates]))
+    results = [dict(method=method, parameter=parameter, L=L, **scores)
+               for (method, parameter, L), scores in zip(candidates, scores)]
+    rank = np.zeros(len(results))
+    for metric in ('rms', 'convergence', 'noise'):
+        values = [result[metric] for result in results]
+        rank += np.argsort(np.argsort(values, kind='stable'), kind='stable')
+    return [results[i] for i in np.argsort(rank, kind='stable')]
+
+
+class ResidualDetector:
+    """Online alarms on the prediction errors of N observers with q outputs
+
+    Three statistics are kept for each unit, all updated with a fixed number
+    of array operations per sample:
+
+    - EWMA: exponentially weighted mean and variance of each residual. The
+      alarm is raised when the mean leaves the band of limit standard
+      deviations of an EWMA of white noise.
+    - CUSUM: two sided cumulative sums of the standardized residuals with
+      slack k, raised when either sum exceeds h.
+    - chi2: the squared Mahalanobis distance e' S^-1 e of the residual
+      vector using the innovation covariance S, raised when it exceeds the
+      chi-square quantile for the confidence level.
+
+    Unless the innovation covariance is given, it is learned from the
+    residuals over the first warmup samples, which should be fault free.
+    Each time an alarm is raised or cleared the value 1 or 0 is recorded as
+    an event named '<prefix>[<unit>].<statistic>' in the events table of the
+    historian's database, so alarms take one row per change and do not
+    appear among the sampled tags. Read them with historian.db.get_events().
+    """
+    statistics = ('ewma', 'cusum', 'chi2')
+
+    def __init__(self, q, units=1, S=None, mean=None, warmup=30, alpha=0.1,
+                 limit=3.0, k=0.5, h=5.0, level=0.999, historian=None,
+                 prefix='alarm'):
+        """
+        q: number of residuals per unit
+        units: number of units N
+        S: (q, q) or (N, q, q) innovation covariance, learned if None
+        mean: (q,) or (N, q) residual mean without faults, by default zero
+        warmup: number of samples used to learn S
+        alpha: EWMA weight of the newest sample
+        limit: EWMA alarm limit in standard deviations
+        k, h: CUSUM slack and threshold in standard deviations
+        level: confidence level for the chi-square alarm
+        historian: Historian to record alarm events in, or None
+        prefix: prefix of the event tag names
+        """
+        self.q = q
+        self.units = units
+        self.alpha = alpha
+        self.limit = limit
+        self.k = k
+        self.h = h
+        self.threshold = chi2.ppf(level, q)
+        self.historian = historian
+        self.prefix = prefix
+        self.count = 0
+        self.warmup = 0 if S is not None else warmup
+        self.mean0 = np.zeros((units, q))
+        if mean is not None:
+            self.mean0[:] = mean
+        self.M2 = np.zeros((units, q, q))
+        self.mean = self.mean0.copy()
+        self.var = np.zeros((units, q))
+        self.cusum = np.zeros((2, units, q))
+        self.chi2 = np.zeros(units)
+        self.alarms = dict((name, np.zeros(units, dtype=bool))
+                           for name in self.statistics)
+        if S is not None:
+            self.set_covariance(np.broadcast_to(S, (units, q, q)))
+        elif warmup < 1:
+            raise ValueError('warmup samples are needed when S is not given')
+
+    def set_covariance(self, S):
+        """Use S as the innovation covariance and reset the running statistics"""
+        self.S = np.array(S, dtype=float)
+        self.Sinv = np.linalg.inv(self.S)
+        self.sigma = np.sqrt(np.diagonal(self.S, axis1=1, axis2=2))
+        self.mean = self.mean0.copy()
+        self.var = self.sigma**2
+
+    @property
+    def alarm(self):
+        """Boolean array, True for units with any alarm raised"""
+        return self.alarms['ewma'] | self.alarms['cusum'] | self.alarms['chi2']
+
+    def update(self, t, y_err):
+        """Add one residual vector for each unit
+
+        t: time of the sample, used for the recorded events
+        y_err: (N, q) prediction errors, or (q,) for a single unit
+
+        Returns the alarm array. NaN residuals, as yielded by an observer
+        before its first measurement, are ignored.
+        """
+        if y_err is None:
+            return self.alarm
+        e = np.asarray(y_err, dtype=float).reshape(self.units, self.q)
+        if np.isnan(e).any():
+            return self.alarm
+        self.count += 1
+        if self.count <= self.warmup:
+            r = e - self.mean0
+            self.M2 += r[:, :, None] * r[:, None, :]
+            if self.count == self.warmup:
+                self.set_covariance(self.M2/self.count)
+            return self.alarm
+
+        a = self.alpha
+        d = e - self.mean
+        self.mean += a*d
+        self.var = (1 - a)*(self.var + a*d**2)
+        band = self.limit*self.sigma*np.sqrt(a/(2 - a))
+        ewma = (np.abs(self.mean - self.mean0) > band).any(axis=1)
+
+        z = (e - self.mean0)/self.sigma
+        self.cusum[0] = np.maximum(0, self.cusum[0] + z - self.k)
+        self.cusum[1] = np.maximum(0, self.cusum[1] - z - self.k)
+        cusum = (self.cusum > self.h).any(axis=(0, 2))
+
+        r = e - self.mean0
+        self.chi2 = np.einsum('ni,nij,nj->n', r, self.Sinv, r)
+        self.record(t, ewma=ewma, cusum=cusum, chi2=self.chi2 > self.threshold)
+        return self.alarm
+
+    def record(self, t, **alarms):
+        """Store new alarm states and record the changes as events"""
+        for name, alarm in alarms.items():
+            changed = np.flatnonzero(alarm != self.alarms[name])
+            self.alarms[name] = alarm
+            if self.historian is not None and self.historian.db and len(changed):
+                self.historian.db.record_events(
+                    t, [(f'{self.prefix}[{i}].{name}', int(alarm[i]))
+                        for i in changed])
+
+    def reset(self, unit=slice(None)):
+        """Restart the CUSUM sums and EWMA mean, for example after a fault is fixed"""
+        self.cusum[:, unit] = 0
+        self.mean[unit] = self.mean0[unit]
+
+
+# steady-state Kalman filters by model, time step and noise covariances
+_kalman_gains = {}
+
+
+def process_noise(A, Q, dt):
+    """Covariance of the state disturbance accumulated over dt seconds by
+    white noise of intensity Q, computed with Van Loan's method"""
+    n = A.shape[0]
+    M = np.zeros((2*n, 2*n))
+    M[:n, :n] = -A
+    M[:n, n:] = Q
+    M[n:, n:] = A.T
+    E = expm(M*dt)
+    Qd = E[n:, n:].T @ E[:n, n:]
+    return (Qd + Qd.T)/2
+
+
+def steady_state_gain(model, Q, R, dt):
+    """Return (K, P_pred, P, Qd) for the steady-state Kalman filter
+
+    Q: (n, n) intensity of white process noise, in units of state squared
+       per second
+    R: (q, q) covariance of the measurement noise
+    dt: sample interval
+
+    K is the gain, P_pred and P the error covariances before and after a
+    measurement, and Qd the process noise added at each step. The discrete
+    algebraic Riccati equation is solved once for each model, dt, Q and R.
+    """
+    Q = np.asarray(Q, dtype=float)
+    R = np.atleast_2d(np.asarray(R, dtype=float))
+    key = (model.A.tobytes(), model.C.tobytes(), round(dt, 9),
+           Q.tobytes(), R.tobytes())
+    if key not in _kalman_gains:
+        Ad, Bud, Bdd = model.discretize(dt)
+        C = model.C
+        Qd = process_noise(model.A, Q, dt)
+        P_pred = solve_discrete_are(Ad.T, C.T, Qd, R)
+        K = P_pred @ C.T @ np.linalg.inv(C @ P_pred @ C.T + R)
+        P = (np.eye(model.n) - K @ C) @ P_pred
+        _kalman_gains[key] = K, P_pred, P, Qd
+    return _kalman_gains[key]
+
+
+def kalman_filter(model, Q, R, x_initial, d_hat=(), P_initial=None, rtol=1e-6):
+    """Kalman filter with the send([t, u, y]) protocol of tclab_observer()
+
+    Yields the state estimate and the prediction error y_pred - y, then
+    receives [t, u, y]. The steady-state gain for each sample interval comes
+    from steady_state_gain(), so in steady state each sample costs the same
+    as the Luenberger observer. The error covariance is propagated only
+    while it differs from the steady state: after starting from P_initial,
+    and after missing measurements, given as None or NaN entries of y.
+    A measurement at the time of the previous one only updates y_err.
+
+    model: an LTIModel
+    Q: (n, n) process noise intensity, see steady_state_gain()
+    R: (q, q) measurement noise covariance
+    x_initial: initial state estimate
+    d_hat: disturbance estimate
+    P_initial: covariance of the initial estimate, by default the steady
+               state covariance
+    rtol: relative tolerance for returning to the steady-state gain
+    """
+    Q = np.asarray(Q, dtype=float)
+    R = np.atleast_2d(np.asarray(R, dtype=float))
+    C = model.C
+    d_hat = np.atleast_1d(np.asarray(d_hat, dtype=float))
+    P = None if P_initial is None else np.asarray(P_initial, dtype=float)
+    t = 0
+    x_hat = np.asarray(x_initial, dtype=float)
+    y_err = None
+    while True:
+        t_prev = t
+        t, u, y = yield x_hat, y_err
+        dt = t - t_prev
+        y = np.full(C.shape[0], np.nan) if y is None else np.atleast_1d(
+            np.asarray(y, dtype=float))
+        if dt <= 0:
+            y_err = C @ x_hat - y
+            continue
+        x_pred = model.step(x_hat, u, d_hat, dt)
+        y_err = C @ x_pred - y
+        measured = ~np.isnan(y)
+        K, P_pred_ss, P_ss, Qd = steady_state_gain(model, Q, R, dt)
+        if P is None and measured.all():
+            x_hat = x_pred - K @ y_err
+            continue
+
+        # time-varying filter
+        Ad = model.discretize(dt)[0]
+        P_pred = Ad @ (P_ss if P is None else P) @ Ad.T + Qd
+        Cm = C[measured]
+        if len(Cm):
+            S = Cm @ P_pred @ Cm.T + R[np.ix_(measured, measured)]
+            Km = P_pred @ Cm.T @ np.linalg.inv(S)
+            x_hat = x_pred - Km @ y_err[measured]
+            P = (np.eye(model.n) - Km @ Cm) @ P_pred
+        else:
+            x_hat = x_pred
+            P = P_pred
+        if measured.all() and np.allclose(P, P_ss, rtol=rtol, atol=0):
+            P = None
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Pyomo estimation and control of the single heater model of
+tclab/07.01-Optimization-Control-and-Estimation-using-Pyomo.
+
+The generators in that notebook build a new ConcreteModel, discretize it
+and start ipopt on every sample. The classes here build their model once,
+with the window data held in mutable Params and the time grid discretized
+explicitly so the grid can move with the data. Each sample only updates
+the Params, shifts the previous solution forward as the initial point and
+re-solves through a persistent solver interface that keeps the model's
+symbolic representation between solves.
+
+    >>> import sys; sys.path.append('code')
+    >>> from heater import moving_horizon_observer
+    >>> observer = moving_horizon_observer(5, executable=ipopt_executable)
+    >>> observer.send(None)
+    >>> t_est, Th, Ts, d = observer.send([t, u, T1])
+    >>> controller = predictive_control(setpoint, 600, moves=20)
+    >>> controller.send(None)
+    >>> u = controller.send([t_est, Th, Ts, d])
+
+real_time_control() has the same interface, but after a first full solve
+it takes one SQP step per sample on the same model. The step is linearized
+at the shifted previous solution while the loop waits for the next sample,
+so only a sparse QP with a known factorization is solved once the
+measurement arrives.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from solvers import ipopt_solver, solve
+
+# parameters of the single heater model in 07.01
+PARAMETERS = dict(P=0.04, Ua=0.068, CpH=6.5, CpS=1.25, Uc=0.036, Tamb=21.0)
+
+
+class MovingHorizonEstimator:
+    """Moving horizon estimator built once and re-solved at each sample
+
+    The model has the states Th and Ts at each of the h most recent samples
+    and fits the measured sensor temperatures by least squares subject to
+    the heater and sensor equations discretized with forward differences
+    between the sample times, as tclab_observer() does with
+    dae.finite_difference. Unlike the notebook the unmeasured disturbance D
+    is one value for the whole window rather than a free value at each
+    sample, which would let the fit match any data and leave the heater
+    temperature undetermined. Until h samples have arrived the unused
+    leading slots carry no weight and have zero width, so the window grows
+    to its full length as in the notebook.
+    """
+    def __init__(self, h=5, solver=None, executable=None, options=None,
+                 **parameters):
+        """
+        h: number of samples in the window
+        solver: a solver from ipopt_solver(), by default one is created
+                with the given executable and options
+        parameters: values replacing those in PARAMETERS
+        """
+        from pyomo.environ import (ConcreteModel, Constraint, Objective,
+                                   Param, RangeSet, Var, minimize)
+
+        p = dict(PARAMETERS, **parameters)
+        self.h = h
+        self.parameters = p
+        self.solver = solver or ipopt_solver(executable, options)
+
+        m = ConcreteModel()
+        m.k = RangeSet(0, h - 1)
+        m.j = RangeSet(0, h - 2)
+        m.dt = Param(m.j, mutable=True, initialize=0)
+        m.u = Param(m.k, mutable=True, initialize=0)
+        m.Ts_meas = Param(m.k, mutable=True, initialize=p['Tamb'])
+        m.w = Param(m.k, mutable=True, initialize=0)
+        m.Th = Var(m.k, initialize=p['Tamb'])
+        m.Ts = Var(m.k, initialize=p['Tamb'])
+        m.D = Var(initialize=0)
+        m.heater = Constraint(m.j, rule=lambda m, k:
+            p['CpH']*(m.Th[k + 1] - m.Th[k]) == m.dt[k]*(
+                p['Ua']*(p['Tamb'] - m.Th[k]) + p['Uc']*(m.Ts[k] - m.Th[k])
+                + p['P']*m.u[k] + m.D))
+        m.sensor = Constraint(m.j, rule=lambda m, k:
+            p['CpS']*(m.Ts[k + 1] - m.Ts[k]) ==
+            m.dt[k]*p['Uc']*(m.Th[k] - m.Ts[k]))
+        m.obj = Objective(expr=sum(m.w[k]*(m.Ts[k] - m.Ts_meas[k])**2
+                                   for k in m.k),
+                          sense=minimize)
+        self.model = m
+
+        # window data, oldest first, starting from the prior point of 07.01
+        self.t = np.full(h, -1.0)
+        self.u = np.zeros(h)
+        self.Ts = np.full(h, p['Tamb'])
+        self.weight = np.zeros(h)
+        self.weight[-1] = 1
+        self.estimate = (-1, [], [], [])
+
+    def shift(self):
+        """Move the previous solution one sample back as the initial point"""
+        m = self.model
+        for var in (m.Th, m.Ts):
+            index = list(var.keys())
+            values = [var[k].value for k in index]
+            for k, value in zip(index[:-1], values[1:]):
+                var[k].set_value(value)
+
+    def update(self, t, u, Ts):
+        """Add a measurement and return (t, Th, Ts, d) estimated at time t
+
+        t: time of the measurement
+        u: heater input sent with the measurement, as to tclab_observer()
+        Ts: measured sensor temperature
+        """
+        m = self.model
+        self.t = np.roll(self.t, -1)
+        self.u = np.roll(self.u, -1)
+        self.Ts = np.roll(self.Ts, -1)
+        self.weight = np.roll(self.weight, -1)
+        self.t[-1], self.u[-1], self.Ts[-1], self.weight[-1] = t, u, Ts, 1
+        dt = np.diff(self.t)
+        dt[self.weight[:-1] == 0] = 0
+        for k in range(self.h):
+            m.u[k].set_value(self.u[k])
+            m.Ts_meas[k].set_value(self.Ts[k])
+            m.w[k].set_value(self.weight[k])
+        for k in range(self.h - 1):
+            m.dt[k].set_value(dt[k])
+        self.shift()
+        solve(self.solver, m)
+        last = self.h - 1
+        self.estimate = (t, m.Th[last].value, m.Ts[last].value, m.D.value)
+        return self.estimate
+
+
+def moving_horizon_observer(h=2, **kwargs):
+    """Generator with the interface of tclab_observer() in 07.01
+
+    Receives [t, u, Ts] and yields (t_est, Th, Ts, d), using one
+    MovingHorizonEstimator for all samples. kwargs are passed to
+    MovingHorizonEstimator.
+    """
+    mhe = MovingHorizonEstimator(h, **kwargs)
+    estimate = mhe.estimate
+    while True:
+        t, u, Ts = yield estimate
+        estimate = mhe.update(t, u, Ts)
+
+
+class PredictiveController:
+    """Setpoint tracking MPC of tclab_control() built once and re-solved
+
+    The heater temperature follows a setpoint over a horizon discretized
+    with backward differences as in the notebook. The grid can be fine near
+    the present and coarse later, with the input held over each interval
+    and each squared error weighted by the length of its interval, which
+    makes the problem several times smaller for the same horizon. The
+    backward difference on a coarse interval is less accurate, but it only
+    affects the far end of the horizon.
+    """
+    def __init__(self, setpoint, h=100, dt=2, moves=None, solver=None,
+                 executable=None, options=None, **parameters):
+        """
+        setpoint: the setpoint, a constant or a function of time such as
+                  tclab_setpoint
+        h: length of the horizon in seconds
+        dt: time step of the grid
+        moves: number of intervals of a grid that is fine near the present
+               and coarse later, see control.move_blocks(). By default the
+               grid has a step of dt, as in the notebook.
+        solver: a solver from ipopt_solver(), by default one is created
+                with the given executable and options
+        parameters: values replacing those in PARAMETERS
+        """
+        from pyomo.environ import (ConcreteModel, Constraint, Objective,
+                                   Param, RangeSet, Var, minimize)
+
+        p = dict(PARAMETERS, **parameters)
+        steps = round(h/dt)
+        if moves is None:
+            blocks = np.ones(steps, dtype=int)
+        else:
+            from control import move_blocks
+            blocks = move_blocks(steps, moves)
+        n = len(blocks)
+        self.setpoint = setpoint
+        self.parameters = p
+        self.solver = solver or ipopt_solver(executable, options)
+        self.offsets = dt*np.concatenate([[0], np.cumsum(blocks)])
+        self.t = None
+
+        m = ConcreteModel()
+        m.k = RangeSet(0, n)
+        m.j = RangeSet(0, n - 1)
+        m.dt = Param(m.j, initialize=lambda m, j: dt*blocks[j])
+        m.w = Param(m.k, initialize=lambda m, k: blocks[k - 1] if k else 0)
+        m.SP = Param(m.k, mutable=True, initialize=p['Tamb'])
+        m.Th0 = Param(mutable=True, initialize=p['Tamb'])
+        m.Ts0 = Param(mutable=True, initialize=p['Tamb'])
+        m.d = Param(mutable=True, initialize=0)
+        m.Th = Var(m.k, initialize=p['Tamb'])
+        m.Ts = Var(m.k, initialize=p['Tamb'])
+        m.U = Var(m.j, bounds=(0, 100), initialize=0)
+        m.Th_initial = Constraint(expr=m.Th[0] == m.Th0)
+        m.Ts_initial = Constraint(expr=m.Ts[0] == m.Ts0)
+        m.heater = Constraint(m.j, rule=lambda m, j:
+            p['CpH']*(m.Th[j + 1] - m.Th[j]) == m.dt[j]*(
+                p['Ua']*(p['Tamb'] - m.Th[j + 1])
+                + p['Uc']*(m.Ts[j + 1] - m.Th[j + 1])
+                + p['P']*m.U[j] + m.d))
+        m.sensor = Constraint(m.j, rule=lambda m, j:
+            p['CpS']*(m.Ts[j + 1] - m.Ts[j]) ==
+            m.dt[j]*p['Uc']*(m.Th[j + 1] - m.Ts[j + 1]))
+        m.obj = Objective(expr=sum(m.w[k]*(m.SP[k] - m.Th[k])**2 for k in m.k),
+                          sense=minimize)
+        self.model = m
+
+    def shift(self, delay):
+        """Move the previous solution delay seconds back as initial point"""
+        m = self.model
+        times = np.minimum(self.offsets + delay, self.offsets[-1])
+        for var in (m.Th, m.Ts):
+            values = np.interp(times, self.offsets,
+                               [var[k].value for k in m.k])
+            for k in m.k:
+                var[k].set_value(values[k])
+        intervals = np.searchsorted(self.offsets, times[:-1], side='right') - 1
+        U = np.clip([m.U[j].value for j in m.j], 0, 100)
+        for j in m.j:
+            m.U[j].set_value(float(U[min(intervals[j], len(U) - 1)]))
+
+    def update(self, t, Th, Ts, d):
+        """Return the heater input from the estimated state at time t"""
+        m = self.model
+        times = t + self.offsets
+        SP = (self.setpoint(times) if callable(self.setpoint) else
+              np.full(len(times), self.setpoint))
+        for k in m.k:
+            m.SP[k].set_value(float(SP[k]))
+        m.Th0.set_value(Th)
+        m.Ts0.set_value(Ts)
+        m.d.set_value(d)
+        if self.t is not None:
+            self.shift(t - self.t)
+        self.t = t
+        solve(self.solver, m)
+        return m.U[0].value
+
+
+def predictive_control(setpoint, h=100, **kwargs):
+    """Generator with the interface of tclab_control() in 07.01
+
+    Receives [t, Th, Ts, d] and yields the heater input, using one
+    PredictiveController for all samples. Unlike the notebook, the input
+    returned is the one applied over the first interval of the horizon.
+    kwargs are passed to PredictiveController.
+    """
+    controller = PredictiveController(setpoint, h, **kwargs)
+    u = 0
+    while True:
+        t, Th, Ts, d = yield u
+        u = controller.update(t, Th, Ts, d)
+
+
+def _evaluate(expressions):
+    from pyomo.environ import value
+
+    return np.fromiter((value(e) for e in expressions), float,
+                       len(expressions))
+
+
+class RealTimeIteration:
+    """SQP steps on a Pyomo model built once
+
+    The first and second derivatives of the objective and constraints are
+    differentiated symbolically once, as are the sensitivities of the
+    constraints to the feedback Params. prepare() evaluates them at the
+    current values of the variables and Params and refactorizes the QP of
+    the next step in OSQP, whose sparsity is fixed. feedback() takes the new
+    values of the feedback Params, typically just set to a measurement,
+    into the QP through the sensitivities, which is exact for Params that
+    enter the constraints linearly such as an initial state, and solves it.
+    The step is applied to the variables in full. The Hessian of the
+    Lagrangian uses the multipliers of the previous step and must be
+    positive semidefinite near the solution.
+    """
+    def __init__(self, model, feedback=(), options=None):
+        """
+        model: a ConcreteModel with one active objective and no fixed
+               variables that change between steps
+        feedback: Params set between prepare() and feedback()
+        options: OSQP settings
+        """
+        import osqp
+        import scipy.sparse as sparse
+        from pyomo.core.expr import identify_variables
+        from pyomo.core.expr.calculus.derivatives import Modes, differentiate
+        from pyomo.environ import Constraint, Objective, Var, maximize
+
+        self.vars = [v for v in model.component_data_objects(Var, active=True)
+                     if not v.fixed]
+        constraints = list(model.component_data_objects(Constraint,
+                                                        active=True))
+        objective = next(model.component_data_objects(Objective, active=True))
+        index = {id(v): i for i, v in enumerate(self.vars)}
+        sign = -1 if objective.sense == maximize else 1
+        n, m = len(self.vars), len(constraints)
+
+        def derivatives(expr, wrt=None):
+            if isinstance(expr, (int, float)):
+                return []
+            if wrt is None:
+                wrt = [v for v in identify_variables(expr) if id(v) in index]
+            if not wrt:
+                return []
+            gradient = differentiate(expr, wrt_list=wrt,
+                                     mode=Modes.reverse_symbolic)
+            return [(k, g) for k, g in enumerate(gradient)
+                    if not (isinstance(g, (int, float)) and g == 0)]
+
+        def gradient(expr):
+            wrt = [v for v in identify_variables(expr) if id(v) in index]
+            return [(index[id(wrt[k])], g) for k, g in derivatives(expr, wrt)]
+
+        def hessian(expr, multiplier):
+            for i, g in gradient(expr):
+                for j, h in gradient(g):
+                    if i <= j:
+                        self.hessian.append((i, j, multiplier, h))
+
+        # constraints as lower - body <= J step <= upper - body
+        self.bodies = [con.body for con in constraints]
+        self.bounds = [(con.lower, con.upper) for con in constraints]
+        self.gradient = gradient(sign*objective.expr)
+        self.jacobian = []
+        self.hessian = []
+        hessian(sign*objective.expr, -1)
+        for row, body in enumerate(self.bodies):
+            self.jacobian += [(row, col, g) for col, g in gradient(body)]
+            hessian(body, row)
+
+        # sensitivities of the bounds of the QP to the feedback Params
+        self.parameters = list(feedback)
+        self.sensitivities = []
+        for row, (body, bounds) in enumerate(zip(self.bodies, self.bounds)):
+            lower, upper = bounds
+            for side, bound in enumerate((lower, upper)):
+                if bound is not None:
+                    self.sensitivities += [
+                        (side, row, k, g)
+                        for k, g in derivatives(bound - body, self.parameters)]
+        self.S = np.zeros((2, m, len(self.parameters)))
+
+        # sparsity of the QP, with the variable bounds below the constraints
+        bounded = [i for i, v in enumerate(self.vars)
+                   if v.has_lb() or v.has_ub()]
+        self.bounded = np.array(bounded, dtype=int)
+        rows = ([row for row, col, g in self.jacobian] +
+                list(range(m, m + len(bounded))))
+        cols = [col for row, col, g in self.jacobian] + bounded
+        A = sparse.csc_matrix((np.arange(1, len(rows) + 1), (rows, cols)),
+                              shape=(m + len(bounded), n))
+        self.A_order = A.data.astype(int) - 1
+        self.A = sparse.csc_matrix((np.zeros(A.nnz),
+                                    A.indices.astype(np.int32),
+                                    A.indptr.astype(np.int32)),
+                                   shape=A.shape)
+        slots = {}
+        for i, j, multiplier, h in self.hessian:
+            slots.setdefault((i, j), len(slots))
+        self.slots = np.array([slots[i, j] for i, j, r, h in self.hessian],
+                              dtype=int)
+        self.multiplier_rows = np.array([r for i, j, r, h in self.hessian],
+                                        dtype=int)
+        keys = list(slots)
+        P = sparse.csc_matrix((np.arange(1, len(keys) + 1),
+                               ([i for i, j in keys], [j for i, j in keys])),
+                              shape=(n, n))
+        self.P_order = P.data.astype(int) - 1
+        self.P = sparse.csc_matrix((np.zeros(P.nnz),
+                                    P.indices.astype(np.int32),
+                                    P.indptr.astype(np.int32)),
+                                   shape=P.shape)
+        self.multipliers = np.zeros(m + len(bounded))
+        self.options = dict(eps_abs=1e-6, eps_rel=1e-6, max_iter=10000,
+                            polishing=False, verbose=False)
+        self.options.update(options or {})
+        self.solver = None
+        self.prepare()
+        self.P.data[:] = self.P_values
+        self.A.data[:] = self.A_values
+        self.solver = osqp.OSQP()
+        self.solver.setup(self.P, self.q, self.A, self.lower, self.upper,
+                          **self.options)
+
+    def prepare(self):
+        """Linearize at the current values of the variables and Params"""
+        n, m = len(self.vars), len(self.bodies)
+        z = np.array([v.value for v in self.vars], dtype=float)
+        self.q = np.zeros(n)
+        np.add.at(self.q, [i for i, g in self.gradient],
+                  _evaluate([g for i, g in self.gradient]))
+        jacobian = _evaluate([g for row, col, g in self.jacobian])
+        A = np.concatenate([jacobian, np.ones(len(self.bounded))])
+        self.A_values = A[self.A_order]
+        multipliers = self.multipliers[np.maximum(self.multiplier_rows, 0)]
+        weights = np.where(self.multiplier_rows < 0, 1.0, multipliers)
+        P = np.zeros(len(self.P_order))
+        hessian = _evaluate([h for i, j, r, h in self.hessian])
+        np.add.at(P, self.slots, weights*hessian)
+        self.P_values = P[self.P_order]
+
+        body = _evaluate(self.bodies)
+        lower = np.array([-np.inf if lb is None else lb
+                          for lb, ub in self.bounds], dtype=object)
+        upper = np.array([np.inf if ub is None else ub
+                          for lb, ub in self.bounds], dtype=object)
+        lb = np.array([-np.inf if self.vars[i].lb is None else self.vars[i].lb
+                       for i in self.bounded], dtype=float)
+        ub = np.array([np.inf if self.vars[i].ub is None else self.vars[i].ub
+                       for i in self.bounded], dtype=float)
+        self.lower = np.concatenate([_evaluate(lower) - body,
+                                     lb - z[self.bounded]])
+        self.upper = np.concatenate([_evaluate(upper) - body,
+                                     ub - z[self.bounded]])
+        self.S[:] = 0
+        if self.sensitivities:
+            side, row, k, g = zip(*self.sensitivities)
+            self.S[side, row, k] = _evaluate(g)
+        self.values = _evaluate(self.parameters)
+        if self.solver is not None:
+            self.solver.update(q=self.q, l=self.lower, u=self.upper,
+                               Px=self.P_values, Ax=self.A_values)
+
+    def feedback(self):
+        """Solve the QP with the current feedback Params and take the step
+
+        Returns True if the QP was solved.
+        """
+        change = _evaluate(self.parameters) - self.values
+        if change.any():
+            m = len(self.bodies)
+            lower, upper = self.lower.copy(), self.upper.copy()
+            lower[:m] += self.S[0] @ change
+            upper[:m] += self.S[1] @ change
+            self.solver.update(l=lower, u=upper)
+        self.solver.warm_start(y=self.multipliers)
+        results = self.solver.solve()
+        if results.info.status not in ('solved', 'solved inaccurate'):
+            return False
+        for v, step in zip(self.vars, results.x):
+            v.set_value(v.value + step, skip_validation=True)
+        self.multipliers = results.y.copy()
+        return True
+
+
+class RealTimeController(PredictiveController):
+    """PredictiveController taking one SQP step per sample
+
+    The first sample is solved to convergence with ipopt. Afterwards
+    prepare() shifts the previous solution to the time of the next sample,
+    sets the setpoints and linearizes the model there, and update() only
+    sets the estimated state and disturbance and solves the QP of the step,
+    the real-time iteration scheme. If update() is called for a time that
+    was not prepared, both phases run then.
+    """
+    def __init__(self, setpoint, h=100, dt=2, moves=None, qp_options=None,
+                 **kwargs):
+        """
+        setpoint, h, dt, moves: as for PredictiveController
+        qp_options: OSQP settings for the QP of each step
+        kwargs: passed to PredictiveController
+        """
+        super().__init__(setpoint, h, dt, moves, **kwargs)
+        m = self.model
+        self.rti = RealTimeIteration(m, [m.Th0, m.Ts0, m.d], qp_options)
+        self.prepared = None
+        self.origin = None          # time of the start of the trajectory
+
+    def prepare(self, t):
+        """Linearize at the previous solution shifted to time t"""
+        m = self.model
+        SP = (self.setpoint(t + self.offsets) if callable(self.setpoint) else
+              np.full(len(self.offsets), self.setpoint))
+        for k in m.k:
+            m.SP[k].set_value(float(SP[k]))
+        self.shift(t - self.origin)
+        self.origin = t
+        self.rti.prepare()
+        self.prepared = t
+
+    def update(self, t, Th, Ts, d):
+        """Return the heater input from the estimated state at time t"""
+        if self.t is None:
+            self.origin = t
+            return super().update(t, Th, Ts, d)
+        m = self.model
+        if self.prepared != t:
+            self.prepare(t)
+        m.Th0.set_value(Th)
+        m.Ts0.set_value(Ts)
+        m.d.set_value(d)
+        self.rti.feedback()
+        self.t = self.origin = t
+        return m.U[0].value
+
+
+def real_time_control(setpoint, h=100, dt=2, **kwargs):
+    """Generator with the interface of tclab_control() in 07.01
+
+    Receives [t, Th, Ts, d] and yields the heater input from a
+    RealTimeController. The preparation for the next sample, expected one
+    sample period later, runs in a background thread while the caller
+    applies the input and waits for the next measurement. kwargs are passed
+    to RealTimeController.
+    """
+    controller = RealTimeController(setpoint, h, dt, **kwargs)
+    u = 0
+    period = dt
+    preparation = None
+    with ThreadPoolExecutor(1) as executor:
+        while True:
+            t, Th, Ts, d = yield u
+            if preparation is not None:
+                preparation.result()
+            if controller.t is not None and t > controller.t:
+                period = t - controller.t
+            u = controller.update(t, Th, Ts, d)
+            preparation = executor.submit(controller.prepare, t + period)
@@ -0,0 +1,1368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Extensions to the tclab Historian for long-running and archived experiments.
+
+The Historian distributed with tclab stores every sample as one row of an
+entity-attribute-value table with no index. This module provides drop-in
+replacements that keep the same interface (``update``, ``log``, ``logdict``,
+``get_sessions``, ``load_session``, ...) while storing data in a form that
+can be queried efficiently as the history grows. Unlike tclab.Historian,
+the in-memory columns hold floats, so values must be numbers or None and
+``log`` returns them as Python floats, for example ``[(0.0, 1.0)]``.
+
+    >>> import sys; sys.path.append('code')
+    >>> from historian import Historian
+    >>> h = Historian(lab.sources, dbfile="data/tclab_historian.db")
+"""
+
+import atexit
+import datetime
+import glob
+import math
+import os
+import re
+import sqlite3
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tclab
+from tclab.historian import TagDB
+from tclab.labtime import labtime
+
+
+class BufferedTagDB(TagDB):
+    """Interface to a tagvalues database with a write-behind buffer
+
+    Rows are held in memory and written with a single ``executemany``
+    transaction once ``batchsize`` samples have accumulated or ``flushtime``
+    seconds have passed since the last write. The buffer is also written
+    before any query, on ``close()``, when the object is garbage collected
+    and when the interpreter exits. A Historian that is never closed keeps
+    its samples once it is collected:
+
+    >>> import gc, os, sqlite3, tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'gc.db')
+    >>> def experiment():
+    ...     h = Historian([('a', lambda: 1.0)], dbfile=filename)
+    ...     for t in range(5):
+    ...         h.update(t)
+    >>> experiment(); _ = gc.collect()
+    >>> sqlite3.connect(filename).execute("SELECT COUNT(*) FROM samples").fetchone()
+    (5,)
+    """
+    insert = "INSERT INTO tagvalues VALUES (?, ?, ?, ?)"
+    table = "tagvalues"
+    tagcolumn = "name"
+    # columns telling samples apart within a session
+    sample = "timeseconds"
+    # sparse events such as alarms, kept apart from the sampled tags
+    events = """CREATE TABLE IF NOT EXISTS events (
+                    session_id INTEGER NOT NULL,
+                    timeseconds REAL NOT NULL,
+                    name TEXT NOT NULL,
+                    value REAL)"""
+
+    def __init__(self, filename=":memory:", batchsize=100, flushtime=1.0,
+                 journal_mode=None, synchronous=None):
+        """Create or connect to a database
+
+        :param filename: The filename of the database.
+                         By default, values are stored in memory.
+        :param batchsize: Number of samples buffered before writing.
+                          Use 1 to write every sample immediately.
+        :param flushtime: Maximum time in seconds a sample stays buffered.
+        :param journal_mode: sqlite journal mode, for example 'WAL'.
+        :param synchronous: sqlite synchronous level, 'OFF', 'NORMAL',
+                            'FULL' or 'EXTRA'."""
+        super().__init__(filename)
+        self.cursor.execute(self.events)
+        self.db.commit()
+        self.configure(batchsize, flushtime, journal_mode, synchronous)
+
+    def configure(self, batchsize=100, flushtime=1.0,
+                  journal_mode=None, synchronous=None):
+        """Set buffering and durability options"""
+        if journal_mode is not None:
+            self.cursor.execute("PRAGMA journal_mode={}".format(journal_mode))
+        if synchronous is not None:
+            self.cursor.execute("PRAGMA synchronous={}".format(synchronous))
+        self.batchsize = batchsize
+        self.flushtime = flushtime
+        self.buffer = []
+        self.pending = 0
+        self.lastflush = time.time()
+        self.closed = False
+        _unflushed.add(self)
+
+    def row(self, timeseconds, name, value):
+        return (self.session, timeseconds, name, value)
+
+    def record_sample(self, timeseconds, items):
+        """Buffer the values of several tags taken at the same time
+
+        :param timeseconds: Time of the sample.
+        :param items: An iterable of (name, value) tuples."""
+        if self.session is None:
+            self.new_session()
+        self.buffer.extend(self.row(timeseconds, name, value)
+                           for name, value in items)
+        self.pending += 1
+        if (self.pending >= self.batchsize or
+                time.time() - self.lastflush >= self.flushtime):
+            self.flush()
+
+    def record(self, timeseconds, name, value):
+        self.record_sample(timeseconds, [(name, value)])
+
+    def record_events(self, timeseconds, items):
+        """Write events that happened at the same time
+
+        Events are stored in the events table rather than as tags, so they
+        do not appear in get_tags(), query() or a loaded session.
+
+        :param timeseconds: Time of the events.
+        :param items: An iterable of (name, value) tuples."""
+        if self.session is None:
+            self.new_session()
+        with self.db:
+            self.cursor.executemany(
+                "INSERT INTO events VALUES (?, ?, ?, ?)",
+                [(self.session, timeseconds, name, value) for name, value in items])
+
+    def get_events(self, session=None, name=None):
+        """Return the (timeseconds, name, value) events of a session in time order
+
+        :param session: Session id, by default the current session.
+        :param name: If given, return only events with this name."""
+        if session is None:
+            session = self.session
+        query = "SELECT timeseconds, name, value FROM events WHERE session_id=?"
+        parameters = [session]
+        if name is not None:
+            query += " AND name=?"
+            parameters.append(name)
+        query += " ORDER BY timeseconds, rowid"
+        return list(self.cursor.execute(query, parameters))
+
+    def flush(self):
+        """Write buffered rows to the database in one transaction"""
+        if self.buffer:
+            with self.db:
+                self.write(self.buffer)
+            self.buffer = []
+        self.pending = 0
+        self.lastflush = time.time()
+
+    def write(self, rows):
+        """Insert rows into the database inside an open transaction"""
+        self.cursor.executemany(self.insert, rows)
+
+    def get_sessions(self):
+        self.flush()
+        return super().get_sessions()
+
+    def get(self, name, timeseconds=None, session=None):
+        self.flush()
+        return super().get(name, timeseconds, session)
+
+    def delete_session(self, session_id):
+        self.flush()
+        super().delete_session(session_id)
+        self.cursor.execute("DELETE FROM events WHERE session_id=?", (session_id,))
+        self.db.commit()
+
+    def tagkey(self, name):
+        """Return the value identifying a tag in the tag column"""
+        return name
+
+    def get_tags(self, session=None):
+        """Return the names of the tags recorded in a session"""
+        self.flush()
+        if session is None:
+            session = self.session
+        query = "SELECT DISTINCT name FROM tagvalues WHERE session_id=?"
+        return [name for (name,) in self.cursor.execute(query, (session,))]
+
+    def query(self, tags, session=None, t0=None, t1=None, every=None,
+              chunksize=None):
+        """Return values of selected tags over a time range
+
+        Filtering by session, tag and time is done by sqlite so only the
+        requested rows are read from the database.
+
+        :param tags: List of tag names.
+        :param session: Session id, by default the current session.
+        :param t0: Start of the time range (inclusive).
+        :param t1: End of the time range (inclusive).
+        :param every: If given, return only the first sample in each
+                      interval of this many seconds.
+        :param chunksize: If given, return an iterator of dictionaries with
+                          at most chunksize samples each.
+        :return: Dictionary of NumPy arrays keyed by 'Time' and tag name,
+                 or an iterator of such dictionaries.
+        """
+        self.flush()
+        if session is None:
+            session = self.session
+        keys = [self.tagkey(name) for name in tags]
+        where = "session_id=? AND {} IN ({})".format(
+            self.tagcolumn, ", ".join("?"*len(keys)))
+        parameters = [session] + keys
+        window = ""
+        if t0 is not None:
+            window += " AND timeseconds>=?"
+            parameters.append(t0)
+        if t1 is not None:
+            window += " AND timeseconds<=?"
+            parameters.append(t1)
+        if every is not None:
+            window += """ AND timeseconds IN
+                (SELECT MIN(timeseconds) FROM {table}
+                 WHERE session_id=? AND {tag}=?{window}
+                 GROUP BY CAST((timeseconds - ?)/? AS INTEGER))""".format(
+                    table=self.table, tag=self.tagcolumn, window=window)
+            parameters += parameters[:1] + keys[:1] + parameters[1+len(keys):]
+            parameters += [t0 or 0, every]
+        pivot = ", ".join("MAX(CASE WHEN {}=? THEN value END)".format(
+            self.tagcolumn) for _ in keys)
+        query = """SELECT timeseconds, {pivot} FROM {table}
+                   WHERE {where}{window}
+                   GROUP BY {sample} ORDER BY {sample}""".format(
+                       pivot=pivot, table=self.table, where=where, window=window,
+                       sample=self.sample)
+        cursor = self.db.cursor()
+        cursor.execute(query, keys + parameters)
+        columns = ['Time'] + list(tags)
+        chunks = _chunks(cursor, columns, chunksize)
+        if chunksize is None:
+            return next(chunks)
+        return chunks
+
+    def timespan(self, name, session=None):
+        """Return the first and last time at which a tag was recorded"""
+        self.flush()
+        if session is None:
+            session = self.session
+        # separate subqueries let sqlite read each end of the index
+        query = """SELECT (SELECT MIN(timeseconds) FROM {table}
+                           WHERE session_id=? AND {tag}=?),
+                          (SELECT MAX(timeseconds) FROM {table}
+                           WHERE session_id=? AND {tag}=?)""".format(
+                               table=self.table, tag=self.tagcolumn)
+        key = self.tagkey(name)
+        return self.cursor.execute(query, (session, key, session, key)).fetchone()
+
+    def downsample(self, tags, session=None, t0=None, t1=None, points=1000,
+                   method='minmax'):
+        """Return at most about points samples of each tag for plotting
+
+        :param tags: List of tag names.
+        :param session: Session id, by default the current session.
+        :param t0: Start of the time range (inclusive).
+        :param t1: End of the time range (inclusive).
+        :param points: Number of points to return for each tag.
+        :param method: 'minmax' keeps the extremes of each time bucket,
+                       'lttb' uses largest-triangle-three-buckets.
+        :return: Dictionary of (time, value) array pairs keyed by tag name.
+        """
+        data = self.query(tags, session, t0, t1)
+        return dict((name, DECIMATORS[method](data['Time'], data[name], points))
+                    for name in tags)
+
+    def close(self):
+        self.flush()
+        _unflushed.discard(self)
+        self.closed = True
+        super().close()
+
+    def __del__(self):
+        # the cycle collector clears weak references before calling __del__,
+        # so _unflushed cannot tell whether the database is still open
+        if getattr(self, 'buffer', None) and not self.closed:
+            self.flush()
+
+
+# databases flushed at interpreter exit, held weakly so a database that is
+# never closed can still be freed
+_unflushed = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all():
+    for tagdb in list(_unflushed):
+        tagdb.flush()
+
+
+class IndexedTagDB(BufferedTagDB):
+    """Interface to an sqlite database storing tag values by session and tag
+
+    Samples are stored in a ``samples`` table clustered on the composite key
+    (session_id, tag_id, timeseconds, seq), so reading one tag of one session
+    is a single range scan whose cost does not depend on the size of the
+    other sessions held in the same file. seq numbers samples recorded at
+    the same time, which are all kept as in tclab.Historian. Tag names are
+    stored once in ``tags``. Writes are buffered as in BufferedTagDB.
+
+    Each write also updates the ``rollups`` table holding count, sum, min,
+    max and last value of every tag over time buckets of the widths listed
+    in ``resolutions``, so long sessions can be plotted from a few thousand
+    rows instead of every raw sample.
+    """
+    creates = ["""CREATE TABLE IF NOT EXISTS sessions (
+                       id INTEGER PRIMARY KEY,
+                       starttime)""",
+               """CREATE TABLE IF NOT EXISTS tags (
+                       id INTEGER PRIMARY KEY,
+                       name TEXT UNIQUE NOT NULL)""",
+               """CREATE TABLE IF NOT EXISTS samples (
+                       session_id INTEGER NOT NULL REFERENCES sessions (id),
+                       tag_id INTEGER NOT NULL REFERENCES tags (id),
+                       timeseconds REAL NOT NULL,
+                       seq INTEGER NOT NULL DEFAULT 0,
+                       value REAL,
+                       PRIMARY KEY (session_id, tag_id, timeseconds, seq))
+                       WITHOUT ROWID""",
+               """CREATE TABLE IF NOT EXISTS session_files (
+                       session_id INTEGER PRIMARY KEY REFERENCES sessions (id),
+                       filename TEXT UNIQUE NOT NULL,
+                       stamp TEXT)""",
+               """CREATE TABLE IF NOT EXISTS rollups (
+                       session_id INTEGER NOT NULL REFERENCES sessions (id),
+                       tag_id INTEGER NOT NULL REFERENCES tags (id),
+                       width REAL NOT NULL,
+                       bucket INTEGER NOT NULL,
+                       n INTEGER, vsum REAL,
+                       vmin REAL, tvmin REAL,
+                       vmax REAL, tvmax REAL,
+                       vlast REAL, tlast REAL,
+                       PRIMARY KEY (session_id, tag_id, width, bucket))
+                       WITHOUT ROWID""",
+               BufferedTagDB.events]
+    # the seq of a sample is the number recorded before it at the same time
+    insert = """INSERT INTO samples VALUES (?1, ?2, ?3,
+                    (SELECT COUNT(*) FROM samples
+                     WHERE session_id=?1 AND tag_id=?2 AND timeseconds=?3),
+                    ?4)"""
+    upsert = """INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (session_id, tag_id, width, bucket) DO UPDATE SET
+                    n=n + excluded.n,
+                    vsum=vsum + excluded.vsum,
+                    tvmin=CASE WHEN excluded.vmin < vmin
+                               THEN excluded.tvmin ELSE tvmin END,
+                    vmin=MIN(vmin, excluded.vmin),
+                    tvmax=CASE WHEN excluded.vmax > vmax
+                               THEN excluded.tvmax ELSE tvmax END,
+                    vmax=MAX(vmax, excluded.vmax),
+                    vlast=CASE WHEN excluded.tlast >= tlast
+                               THEN excluded.vlast ELSE vlast END,
+                    tlast=MAX(tlast, excluded.tlast)"""
+    table = "samples"
+    tagcolumn = "tag_id"
+    sample = "timeseconds, seq"
+
+    def __init__(self, filename=":memory:", resolutions=(10, 60, 600, 3600),
+                 **options):
+        """Create or connect to a database
+
+        :param filename: The filename of the database.
+                         By default, values are stored in memory.
+        :param resolutions: Widths in seconds of the rollup buckets
+                            maintained on write. Use () to disable rollups.
+        :param options: Buffering and durability options, see BufferedTagDB."""
+        self.db = sqlite3.connect(filename)
+        self.cursor = self.db.cursor()
+        tables = {name for (name,) in self.cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")}
+        if "tagvalues" in tables:
+            self.db.close()
+            raise ValueError("{} uses the tagvalues layout. Convert it with "
+                             "migrate('{}') or open it with engine='eav'."
+                             .format(filename, filename))
+        for statement in self.creates:
+            self.cursor.execute(statement)
+        # samples of files written before seq was added have unique times
+        if "seq" not in [column[1] for column in self.cursor.execute(
+                "PRAGMA table_info(samples)")]:
+            self.cursor.execute("ALTER TABLE samples RENAME TO samples_old")
+            self.cursor.execute(self.creates[2])
+            self.cursor.execute("""INSERT INTO samples
+                SELECT session_id, tag_id, timeseconds, 0, value FROM samples_old""")
+            self.cursor.execute("DROP TABLE samples_old")
+        # files ingested before the raw timestamp was kept have no stamp
+        if "stamp" not in [column[1] for column in self.cursor.execute(
+                "PRAGMA table_info(session_files)")]:
+            self.cursor.execute("ALTER TABLE session_files ADD COLUMN stamp TEXT")
+        self.db.commit()
+        self.tag_ids = dict((name, id) for id, name in
+                            self.cursor.execute("SELECT id, name FROM tags"))
+        self.session = None
+        self.resolutions = sorted(resolutions)
+        self.configure(**options)
+
+    def tag_id(self, name):
+        """Return the integer id of a tag, creating it if necessary"""
+        if name not in self.tag_ids:
+            self.cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)",
+                                (name,))
+            self.cursor.execute("SELECT id FROM tags WHERE name=?", (name,))
+            self.tag_ids[name] = self.cursor.fetchone()[0]
+        return self.tag_ids[name]
+
+    def row(self, timeseconds, name, value):
+        return (self.session, self.tag_id(name), timeseconds, value)
+
+    def write(self, rows):
+        self.cursor.executemany(self.insert, rows)
+        self.cursor.executemany(self.upsert, self.rollup(rows))
+
+    def rollup(self, rows):
+        """Aggregate (session_id, tag_id, timeseconds, value) rows by bucket"""
+        buckets = {}
+        for session, tag, t, value in rows:
+            if value is None:
+                continue
+            for width in self.resolutions:
+                key = (session, tag, width, math.floor(t / width))
+                b = buckets.get(key)
+                if b is None:
+                    buckets[key] = [1, value, value, t, value, t, value, t]
+                    continue
+                b[0] += 1
+                b[1] += value
+                if value < b[2]:
+                    b[2], b[3] = value, t
+                if value > b[4]:
+                    b[4], b[5] = value, t
+                if t >= b[7]:
+                    b[6], b[7] = value, t
+        return [key + tuple(b) for key, b in buckets.items()]
+
+    def rebuild_rollups(self, session=None, chunksize=100000):
+        """Recompute the rollups of a session, or of all sessions"""
+        self.flush()
+        sessions = [session] if session else [s[0] for s in self.get_sessions()]
+        reader = self.db.cursor()
+        for session in sessions:
+            with self.db:
+                self.cursor.execute("DELETE FROM rollups WHERE session_id=?",
+                                    (session,))
+                reader.execute("""SELECT session_id, tag_id, timeseconds, value
+                                  FROM samples WHERE session_id=?""", (session,))
+                rows = reader.fetchmany(chunksize)
+                while rows:
+                    self.cursor.executemany(self.upsert, self.rollup(rows))
+                    rows = reader.fetchmany(chunksize)
+
+    def downsample(self, tags, session=None, t0=None, t1=None, points=1000,
+                   method='minmax'):
+        if session is None:
+            session = self.session
+        result = {}
+        for name in tags:
+            start, end = self.timespan(name, session)
+            if start is None:
+                result[name] = (np.array([]), np.array([]))
+                continue
+            start = start if t0 is None else max(t0, start)
+            end = end if t1 is None else min(t1, end)
+            # use the finest rollup with few enough buckets, or raw samples
+            # if the window is short enough to need no rollup at all
+            budget = points // 2 if method == 'minmax' else 4*points
+            widths = [w for w in self.resolutions
+                      if (end - start)/w <= budget] or self.resolutions[-1:]
+            nraw = self.cursor.execute(
+                """SELECT SUM(n) FROM rollups WHERE session_id=? AND tag_id=?
+                   AND width=? AND bucket BETWEEN ? AND ?""",
+                (session, self.tagkey(name), widths[0],
+                 math.floor(start/widths[0]), math.floor(end/widths[0]))
+            ).fetchone()[0] if widths else None
+            if nraw is None or nraw <= 4*points:
+                data = self.query([name], session, t0, t1)
+                t, v = data['Time'], data[name]
+            else:
+                t, v = self.rollup_series(name, session, start, end,
+                                          widths[0], method)
+            result[name] = DECIMATORS[method](t, v, points)
+        return result
+
+    def rollup_series(self, name, session, t0, t1, width, method='minmax'):
+        """Return a time series assembled from one rollup level"""
+        query = """SELECT bucket, tvmin, vmin, tvmax, vmax, vsum/n FROM rollups
+                   WHERE session_id=? AND tag_id=? AND width=?
+                   AND bucket BETWEEN ? AND ? ORDER BY bucket"""
+        rows = np.array(self.cursor.execute(
+            query, (session, self.tagkey(name), width,
+                    math.floor(t0/width), math.floor(t1/width))).fetchall(),
+            dtype=float).reshape(-1, 6)
+        bucket, tvmin, vmin, tvmax, vmax, vmean = rows.T
+        if method == 'minmax':
+            # interleave the extremes of each bucket in time order
+            first = tvmin <= tvmax
+            t = np.column_stack([np.where(first, tvmin, tvmax),
+                                 np.where(first, tvmax, tvmin)]).ravel()
+            v = np.column_stack([np.where(first, vmin, vmax),
+                                 np.where(first, vmax, vmin)]).ravel()
+            return t, v
+        return (bucket + 0.5)*width, vmean
+
+    def query_sessions(self, tags, sessions=None, t0=None, t1=None):
+        """Return values of selected tags across several sessions
+
+        :param tags: List of tag names.
+        :param sessions: List of session ids, by default all sessions.
+        :param t0: Start of the time range (inclusive).
+        :param t1: End of the time range (inclusive).
+        :return: Dictionary of NumPy arrays keyed by 'Session', 'Time' and
+                 tag name, ordered by session and time.
+        """
+        self.flush()
+        if sessions is None:
+            sessions = [s[0] for s in self.get_sessions()]
+        keys = [self.tagkey(name) for name in tags]
+        pivot = ", ".join("MAX(CASE WHEN tag_id=? THEN value END)"
+                          for _ in keys)
+        query = """SELECT session_id, timeseconds, {} FROM samples
+                   WHERE session_id IN ({}) AND tag_id IN ({})""".format(
+                       pivot, ", ".join("?"*len(sessions)),
+                       ", ".join("?"*len(keys)))
+        parameters = keys + list(sessions) + keys
+        if t0 is not None:
+            query += " AND timeseconds>=?"
+            parameters.append(t0)
+        if t1 is not None:
+            query += " AND timeseconds<=?"
+            parameters.append(t1)
+        query += """ GROUP BY session_id, timeseconds, seq
+                     ORDER BY session_id, timeseconds, seq"""
+        cursor = self.db.cursor()
+        cursor.execute(query, parameters)
+        return next(_chunks(cursor, ['Session', 'Time'] + list(tags)))
+
+    def get_files(self):
+        """Return a dictionary mapping ingested filenames to session ids"""
+        self.flush()
+        return dict((filename, session) for session, filename in
+                    self.cursor.execute(
+                        "SELECT session_id, filename FROM session_files"))
+
+    def get_sessions(self):
+        self.flush()
+        # count the samples of the first tag in each session rather than
+        # scanning every row of every session
+        query = """SELECT id, starttime,
+                          (SELECT COUNT(*) FROM samples
+                           WHERE session_id=sessions.id AND tag_id=
+                               (SELECT MIN(tag_id) FROM samples
+                                WHERE session_id=sessions.id))
+                   FROM sessions ORDER BY starttime, id"""
+        return list(self.cursor.execute(query))
+
+    def tagkey(self, name):
+        return self.tag_ids.get(name, -1)
+
+    def get_tags(self, session=None):
+        self.flush()
+        if session is None:
+            session = self.session
+        query = """SELECT name FROM tags WHERE id IN
+                   (SELECT DISTINCT tag_id FROM samples WHERE session_id=?)
+                   ORDER BY id"""
+        return [name for (name,) in self.cursor.execute(query, (session,))]
+
+    def delete_session(self, session_id):
+        queries = ['DELETE FROM sessions WHERE id = ?',
+                   'DELETE FROM samples WHERE session_id = ?',
+                   'DELETE FROM rollups WHERE session_id = ?',
+                   'DELETE FROM session_files WHERE session_id = ?',
+                   'DELETE FROM events WHERE session_id = ?']
+        self.flush()
+        for query in queries:
+            self.cursor.execute(query, (session_id,))
+        self.db.commit()
+
+    def get(self, name, timeseconds=None, session=None):
+        self.flush()
+        if session is None:
+            session = self.session
+        if name not in self.tag_ids:
+            return []
+        query = """SELECT timeseconds, value FROM samples
+                   WHERE session_id=? AND tag_id=?"""
+        parameters = [session, self.tag_ids[name]]
+        if timeseconds is not None:
+            query += " AND timeseconds=?"
+            parameters.append(timeseconds)
+        query += " ORDER BY timeseconds, seq"
+        return list(self.cursor.execute(query, parameters))
+
+    def clean(self):
+        """Delete sessions with no associated points"""
+        query = """DELETE FROM sessions WHERE NOT EXISTS
+                   (SELECT 1 FROM samples WHERE session_id=sessions.id)"""
+        self.cursor.execute(query)
+        self.db.commit()
+
+
+def _chunks(cursor, columns, chunksize=None):
+    """Yield dictionaries of column arrays from the rows of a cursor"""
+    while True:
+        rows = cursor.fetchmany(chunksize) if chunksize else cursor.fetchall()
+        if chunksize and not rows:
+            return
+        values = np.array(rows, dtype=float).reshape(-1, len(columns))
+        yield dict(zip(columns, values.T))
+        if not chunksize:
+            return
+
+
+def minmax(t, v, points=1000):
+    """Min-max decimation keeping the extremes of points/2 time buckets"""
+    t, v = np.asarray(t, dtype=float), np.asarray(v, dtype=float)
+    if len(t) <= points or t[-1] <= t[0]:
+        return t, v
+    nbins = max(points // 2, 1)
+    bins = np.minimum(((t - t[0])/(t[-1] - t[0])*nbins).astype(int), nbins - 1)
+    order = np.lexsort((v, bins))
+    edges = np.flatnonzero(np.diff(bins[order])) + 1
+    first = np.concatenate([[0], edges])
+    last = np.concatenate([edges, [len(order)]]) - 1
+    keep = np.unique(np.concatenate([order[first], order[last]]))
+    return t[keep], v[keep]
+
+
+def lttb(t, v, points=1000):
+    """Largest-triangle-three-buckets decimation to a fixed number of points"""
+    t, v = np.asarray(t, dtype=float), np.asarray(v, dtype=float)
+    n = len(t)
+    if n <= points or points < 3:
+        return t, v
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    keep = np.zeros(points, dtype=int)
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            tnext = t[hi:edges[i + 2]].mean()
+            vnext = v[hi:edges[i + 2]].mean()
+        else:
+            tnext, vnext = t[-1], v[-1]
+        area = np.abs((t[a] - tnext)*(v[lo:hi] - v[a]) -
+                      (t[a] - t[lo:hi])*(vnext - v[a]))
+        a = lo + np.argmax(area)
+        keep[i + 1] = a
+    keep[-1] = n - 1
+    return t[keep], v[keep]
+
+
+DECIMATORS = {'minmax': minmax, 'lttb': lttb}
+
+
+# storage engines selectable with Historian(..., engine=...)
+ENGINES = {'eav': BufferedTagDB, 'indexed': IndexedTagDB}
+
+
+def detect_engine(filename):
+    """Return the engine for a database: 'eav' if an existing file uses the
+    tclab tagvalues layout, otherwise 'indexed'"""
+    if filename == ":memory:" or not os.path.exists(filename):
+        return 'indexed'
+    db = sqlite3.connect(filename)
+    tables = {name for (name,) in db.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'")}
+    db.close()
+    return 'eav' if "tagvalues" in tables else 'indexed'
+
+
+def migrate(filename):
+    """Convert a database written by tclab.Historian to the indexed layout
+
+    The conversion runs in a single transaction and keeps session ids and
+    start times, so code referring to session numbers continues to work.
+    Rollups are computed for every session once the samples are copied.
+    Files already in the indexed layout are left unchanged.
+
+    :param filename: The filename of the database to convert in place.
+    """
+    db = sqlite3.connect(filename)
+    tables = {name for (name,) in db.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'")}
+    if "tagvalues" not in tables:
+        db.close()
+        return
+    with db:
+        for statement in IndexedTagDB.creates:
+            db.execute(statement)
+        db.execute("""INSERT OR IGNORE INTO tags (name)
+                      SELECT DISTINCT name FROM tagvalues""")
+        db.execute("""INSERT INTO samples
+                      SELECT session_id, tags.id, timeseconds,
+                             ROW_NUMBER() OVER (PARTITION BY session_id,
+                                 tags.id, timeseconds ORDER BY tagvalues.rowid) - 1,
+                             value
+                      FROM tagvalues JOIN tags ON tags.name=tagvalues.name""")
+        db.execute("DROP TABLE tagvalues")
+    db.execute("VACUUM")
+    db.close()
+    tagdb = IndexedTagDB(filename)
+    tagdb.rebuild_rollups()
+    tagdb.db.close()
+
+
+def _read_csv(filename):
+    """Parse one historian CSV file into a list of columns and a value array"""
+    with open(filename) as f:
+        columns = f.readline().strip().split(',')
+        values = np.genfromtxt(f, delimiter=',', ndmin=2)
+    return filename, columns, values.reshape(-1, len(columns))
+
+
+def _starttime(filename, minutes_in_month=False):
+    """Return the start time and timestamp of a data_YYYYMMDDTHHMMSS.csv file
+
+    The start time is formatted like sqlite's datetime(), or is None if the
+    filename does not give a valid date. Files written with
+    strftime('%Y%M%d') have the minutes in place of the month, so with
+    minutes_in_month=True the month is unknown and the start time is None.
+    The timestamp is the raw stamp from the filename, or None if it has none,
+    in which case the start time is the modification time of the file.
+    """
+    match = re.search(r'(\d{4})(\d\d)(\d\d)T(\d\d)(\d\d)(\d\d)',
+                      os.path.basename(filename))
+    if match is None:
+        return datetime.datetime.fromtimestamp(
+            os.path.getmtime(filename)).strftime('%Y-%m-%d %H:%M:%S'), None
+    stamp = match.group(0)
+    if minutes_in_month:
+        return None, stamp
+    try:
+        start = datetime.datetime.strptime(stamp, '%Y%m%dT%H%M%S')
+    except ValueError:
+        return None, stamp
+    return start.strftime('%Y-%m-%d %H:%M:%S'), stamp
+
+
+def ingest(paths, dbfile, processes=None, minutes_in_month=False):
+    """Load a collection of historian CSV files into one indexed database
+
+    Files are parsed in parallel by a pool of processes and written to the
+    database by the calling process, one session per file. The session start
+    time is taken from the timestamp in the filename, see _starttime(), and
+    the raw timestamp is kept in the session_files table. Files ingested
+    previously are skipped, so the function can be rerun as new runs arrive.
+
+    :param paths: A directory, a glob pattern, or a list of CSV filenames.
+                  A directory is searched for data_*.csv files.
+    :param dbfile: The filename of the indexed database to write.
+    :param processes: Number of worker processes, by default one per CPU.
+    :param minutes_in_month: True for files named with the minutes in place
+                             of the month, like those in notebooks/data.
+    :return: Dictionary mapping filenames to session ids.
+
+    >>> ingest("data", "data/runs.db", minutes_in_month=True)
+    >>> runs = IndexedTagDB("data/runs.db").query_sessions(['T1', 'SP1'])
+    """
+    if isinstance(paths, str):
+        if os.path.isdir(paths):
+            paths = os.path.join(paths, 'data_*.csv')
+        paths = glob.glob(paths)
+    tagdb = IndexedTagDB(dbfile)
+    ingested = tagdb.get_files()
+    filenames = sorted(f for f in paths if os.path.abspath(f) not in ingested)
+    with ProcessPoolExecutor(processes) as pool:
+        for filename, columns, values in pool.map(_read_csv, filenames):
+            starttime, stamp = _starttime(filename, minutes_in_month)
+            with tagdb.db:
+                tagdb.cursor.execute("INSERT INTO sessions (starttime) VALUES (?)",
+                                     (starttime,))
+                session = tagdb.cursor.lastrowid
+                tagdb.cursor.execute("INSERT INTO session_files VALUES (?, ?, ?)",
+                                     (session, os.path.abspath(filename), stamp))
+                t = values[:, columns.index('Time')].tolist()
+                for j, name in enumerate(columns):
+                    if name == 'Time':
+                        continue
+                    tag = tagdb.tag_id(name)
+                    tagdb.write([(session, tag, tj, vj) for tj, vj in
+                                 zip(t, values[:, j].tolist())])
+    files = tagdb.get_files()
+    tagdb.db.close()
+    return files
+
+
+class ColumnBuffer:
+    """Growable column of floats stored in one contiguous NumPy array
+
+    Capacity doubles when full, so append is amortized O(1) and the values
+    recorded so far are always available as a NumPy view without copying.
+    Indexing, slicing, len() and iteration behave like the list used by
+    tclab.Historian, but return NumPy floats. Missing values (None) are stored
+    as NaN, and values that cannot be converted to float raise ValueError or
+    TypeError.
+    """
+    def __init__(self, capacity=1024):
+        self.data = np.full(capacity, np.nan)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == len(self.data):
+            self.data = np.concatenate([self.data, np.full(len(self.data), np.nan)])
+        self.data[self.size] = value
+        self.size += 1
+
+    def view(self):
+        """Return the recorded values as a NumPy view"""
+        return self.data[:self.size]
+
+    def snapshot(self):
+        """Return the recorded values as an array later appends leave unchanged
+
+        Appends only write past the end of the view, or move the values to a
+        new array, so this is the view itself.
+        """
+        return self.view()
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.view(), dtype=dtype)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        return self.view()[key]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.view())
+
+
+class RingBuffer(ColumnBuffer):
+    """Fixed-capacity column of floats with O(1) append
+
+    Every value is stored twice, at positions i and i + maxlen of an array of
+    length 2*maxlen, so the most recent maxlen values are always available as
+    one contiguous NumPy view without copying.
+    """
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.data = np.full(2*maxlen, np.nan)
+        self.start = 0
+        self.size = 0
+
+    def append(self, value):
+        end = (self.start + self.size) % self.maxlen
+        self.data[end] = self.data[end + self.maxlen] = value
+        if self.size < self.maxlen:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.maxlen
+
+    def view(self):
+        """Return the retained values, oldest first, as a NumPy view
+
+        Later appends overwrite the values in the view, so use it at once or
+        call snapshot().
+        """
+        return self.data[self.start:self.start + self.size]
+
+    def snapshot(self):
+        """Return a copy of the retained values, oldest first"""
+        return self.view().copy()
+
+    def __repr__(self):
+        return "RingBuffer({}, maxlen={})".format(self.view(), self.maxlen)
+
+
+class Historian(tclab.Historian):
+    """Generalised logging class with a selectable storage engine"""
+    def __init__(self, sources, dbfile=":memory:", engine=None,
+                 maxlen=None, **options):
+        """
+        sources: an iterable of (name, callable) tuples, see tclab.Historian
+        dbfile: filename of the sqlite database, or None to keep data only
+                in memory
+        engine: 'indexed' stores samples clustered by session, tag and time.
+                'eav' uses the original tclab tagvalues layout. By default
+                an existing file is opened with the engine matching its
+                layout, and new databases use 'indexed'. Convert tagvalues
+                files with migrate() to use the indexed engine.
+        maxlen: if given, keep only the most recent maxlen samples in memory
+                using a preallocated RingBuffer for each column. Older
+                samples remain available from dbfile through query(). An
+                in-memory database would grow without bound, so with the
+                default dbfile=":memory:" no database is kept and older
+                samples are dropped. Otherwise each column is a growable
+                ColumnBuffer.
+        options: batchsize, flushtime, journal_mode and synchronous are
+                passed to the storage engine, see BufferedTagDB.
+
+        The Historian can be used as a context so buffered samples are
+        written when the block exits:
+
+        >>> with Historian(lab.sources, dbfile="data/run.db",
+        ...                batchsize=1000, journal_mode='WAL',
+        ...                synchronous='NORMAL') as h:
+        ...     for t in clock(600):
+        ...         h.update(t)
+        """
+        self.sources = [('Time', lambda: self.tnow)] + list(sources)
+        self.maxlen = maxlen
+        if maxlen is not None and dbfile == ":memory:":
+            dbfile = None
+        if dbfile:
+            if engine is None:
+                engine = detect_engine(dbfile)
+            self.db = ENGINES[engine](dbfile, **options)
+            self.db.new_session()
+            self.session = self.db.session
+        else:
+            self.db = None
+            self.session = 1
+
+        self.tstart = labtime.time()
+
+        self.columns = [name for name, _ in self.sources]
+
+        self.build_fields()
+        self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.flush()
+        if self.writer is not None and self.owns_writer:
+            self.writer.close()
+        self.writer = None
+        super().close()
+
+    def build_fields(self):
+        if self.maxlen is None:
+            self.fields = [ColumnBuffer() for _ in self.columns]
+        else:
+            self.fields = [RingBuffer(self.maxlen) for _ in self.columns]
+        self.logdict = dict(zip(self.columns, self.fields))
+        self.t = self.logdict['Time']
+
+    @property
+    def arrays(self):
+        """Dictionary of NumPy arrays of each column, keyed by column name
+
+        The arrays hold the samples recorded when the property was read.
+        Without maxlen they are views sharing memory with the historian.
+        With maxlen they are copies, since the ring buffers are overwritten
+        in place by later samples.
+
+        >>> plt.plot(h.arrays['Time'], h.arrays['T1'])
+        """
+        return dict((c, self.logdict[c].snapshot()) for c in self.columns)
+
+    @property
+    def log(self):
+        return list(zip(*[self.logdict[c].view().tolist() for c in self.columns]))
+
+    def to_frame(self, index='Time'):
+        """Return the log as a pandas DataFrame
+
+        The DataFrame shares memory with the historian unless maxlen is set,
+        see arrays.
+
+        index: column to use as the index, or None for a range index
+        """
+        import pandas as pd
+
+        arrays = self.arrays
+        if index is None:
+            return pd.DataFrame(arrays, columns=self.columns, copy=False)
+        index = pd.Index(arrays.pop(index), name=index, copy=False)
+        return pd.DataFrame(arrays, index=index, copy=False)
+
+    def update(self, tnow=None):
+        if tnow is None:
+            self.tnow = labtime.time() - self.tstart
+        else:
+            self.tnow = tnow
+
+        sample = []
+        for name, valuefunction in self.sources:
+            if valuefunction:
+                v = valuefunction()
+                try:
+                    values = iter(v)
+                except TypeError:
+                    values = iter([v])
+            try:
+                value = next(values)
+            except StopIteration:
+                raise ValueError("valuefunction did not return enough values")
+
+            self.logdict[name].append(value)
+            sample.append((name, value))
+
+        if self.db:
+            self.db.record_sample(self.tnow, sample[1:])
+        if self.writer is not None:
+            self.unarchived += 1
+            if self.unarchived >= self.archivesize:
+                self.write_archive()
+
+    def flush(self):
+        """Write buffered samples to the database and the archive"""
+        if self.db:
+            self.db.flush()
+        if self.writer is not None:
+            self.write_archive()
+
+    def archive(self, filename, batchsize=1000, dtype='float64',
+                compression='zstd'):
+        """Append samples to an Arrow or Parquet file as they are recorded
+
+        Every batchsize samples, and on flush() and close(), the samples
+        recorded since the last write are appended to the file as one record
+        batch or row group, so the file grows with the run while memory does
+        not, also with maxlen. The file is complete once the Historian is
+        closed, and can then be read with read_log().
+
+        filename: a .parquet file, an Arrow IPC file, or a LogWriter, which
+                can be shared by the historians of several runs and is
+                left open on close()
+        batchsize: number of samples per batch, at most maxlen
+        dtype, compression: see LogWriter
+
+        >>> with Historian(lab.sources, maxlen=1000) as h:
+        ...     h.archive("data/run.parquet")
+        ...     for t in clock(3600):
+        ...         h.update(t)
+        """
+        self.owns_writer = not isinstance(filename, LogWriter)
+        if self.owns_writer:
+            self.writer = LogWriter(filename, self.columns, dtype, compression)
+        else:
+            self.writer = filename
+        self.archivesize = min(batchsize, self.maxlen or batchsize)
+        self.unarchived = 0
+        return self.writer
+
+    def write_archive(self):
+        """Append the samples not archived yet to the archive"""
+        if self.unarchived:
+            n = self.unarchived
+            self.writer.write(dict((c, self.logdict[c].view()[-n:])
+                                   for c in self.columns))
+            self.unarchived = 0
+
+    def load_session(self, session):
+        self._dbcheck()
+        self.flush()
+        if isinstance(self.db, IndexedTagDB):
+            # restore the columns recorded in the session being loaded
+            self.columns = ['Time'] + self.db.get_tags(session)
+        super().load_session(session)
+
+    def query(self, session=None, tags=None, t0=None, t1=None, every=None,
+              chunksize=None):
+        """Read selected tags over a time range without loading the session
+
+        session: session id, by default the current session
+        tags: list of tag names, by default all tags recorded in the session
+        t0, t1: time range (inclusive)
+        every: return only the first sample in each interval of every seconds
+        chunksize: if given, return an iterator of dictionaries holding at
+                most chunksize samples each
+
+        Returns a dictionary of NumPy arrays keyed by 'Time' and tag name.
+
+        >>> data = h.query(3, tags=['T1'], t0=100, t1=110)
+        >>> plt.plot(data['Time'], data['T1'])
+        """
+        self._dbcheck()
+        if session is None:
+            session = self.session
+        if tags is None:
+            tags = self.db.get_tags(session)
+        return self.db.query(tags, session, t0, t1, every, chunksize)
+
+    def downsample(self, session=None, tags=None, t0=None, t1=None,
+                   points=1000, method='minmax'):
+        """Read a plot-sized series of each tag
+
+        Long windows are served from the rollups maintained by the indexed
+        engine, so the cost depends on points rather than on the number of
+        samples recorded.
+
+        session, tags, t0, t1: as for query()
+        points: approximate number of points to return for each tag
+        method: 'minmax' or 'lttb'
+
+        Returns a dictionary of (time, value) array pairs keyed by tag name.
+
+        >>> for name, (t, v) in h.downsample(tags=['T1', 'T2']).items():
+        ...     plt.plot(t, v, label=name)
+        """
+        self._dbcheck()
+        if session is None:
+            session = self.session
+        if tags is None:
+            tags = self.db.get_tags(session)
+        return self.db.downsample(tags, session, t0, t1, points, method)
+
+    def to_arrow(self, filename=None, dtype='float64'):
+        """Return the log as a pyarrow Table, optionally saved to a file
+
+        filename: if given, write an uncompressed Arrow IPC (Feather) file
+                that read_log() can memory-map without copying
+        dtype: type used for all columns other than Time, which is always
+                float64
+        """
+        import pyarrow as pa
+
+        arrays = [pa.array(np.asarray(self.logdict[c], dtype=float if
+                                      c == 'Time' else dtype))
+                  for c in self.columns]
+        table = pa.Table.from_arrays(arrays, names=self.columns)
+        if filename:
+            import pyarrow.feather as feather
+            feather.write_feather(table, filename, compression='uncompressed')
+        return table
+
+    def to_parquet(self, filename, dtype='float64', compression='zstd'):
+        """Output contents of log file to a compressed Parquet file"""
+        import pyarrow.parquet as pq
+
+        pq.write_table(self.to_arrow(dtype=dtype), filename,
+                       compression=compression)
+
+
+# plotters that may have samples not drawn yet, see draw_pending()
+_plotters = weakref.WeakSet()
+
+
+def draw_pending():
+    """Redraw every Plotter that has samples recorded since its last redraw
+
+    Plotter.update() skips frames to keep within its frame rate, so the last
+    samples of an experiment may not be shown when the loop ends. The clock()
+    of the simulation module calls this when it finishes.
+    """
+    for plotter in list(_plotters):
+        plotter.flush()
+
+
+class Plotter(tclab.Plotter):
+    """Plotter that redraws incrementally at a bounded frame rate"""
+    def __init__(self, historian, twindow=120, layout=None, fps=2,
+                 decimate=True, maxskip=50):
+        """Generalised graphical output of a Historian
+
+        :param historian: An instance of the Historian class
+        :param twindow: Amount of time to show in the plot
+        :param layout: Fields to plot on each axis, see tclab.Plotter
+        :param fps: Maximum number of redraws per second of wall-clock time,
+                    independent of the control period and speedup.
+        :param decimate: If True, reduce each line to about two points per
+                         pixel of axis width with min-max decimation.
+        :param maxskip: Also redraw when the historian time has advanced
+                        this many seconds since the last redraw, so runs
+                        faster than real time are still shown as they go.
+
+        With backends whose canvas supports blitting, such as
+        ``%matplotlib qt`` or ``tk``, only the lines are redrawn, blitted over
+        a cached background, until the axis limits have to change. The
+        browser canvases of ``%matplotlib notebook`` and ``widget`` do not
+        blit and are redrawn in place, and with ``%matplotlib inline`` a new
+        image is displayed, at most fps times per second. Call flush()
+        or draw_pending() after the last update to show the final samples.
+        """
+        super().__init__(historian, twindow, layout)
+        self.fps = fps
+        self.decimate = decimate
+        self.maxskip = maxskip
+        # the inline backend draws on a plain Agg canvas that is shown as
+        # an image, other backends update their canvas in place
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        canvas = self.fig.canvas
+        self.interactive = type(canvas) is not FigureCanvasAgg
+        self.blit = self.interactive and canvas.supports_blit
+        self.background = None
+        if self.blit:
+            for line in self.lines.values():
+                line.set_animated(True)
+        _plotters.add(self)
+
+    def update(self, tnow=None):
+        self.historian.update(tnow)
+        if (time.time() - self.last_plot_update >= 1/self.fps or
+                self.historian.tnow - self.last_plotted_time >= self.maxskip):
+            self.redraw()
+
+    def flush(self):
+        """Redraw if samples were recorded since the last redraw"""
+        if len(self.historian.t) and self.historian.tnow != self.last_plotted_time:
+            self.redraw()
+
+    def redraw(self):
+        """Update lines with the latest data and show the figure"""
+        tnow = self.historian.tnow
+        t = np.asarray(self.historian.logdict['Time'], dtype=float)
+        tmin = max(tnow - self.twindow, 0)
+        start = max(np.searchsorted(t, tmin, side='right') - 1, 0)
+        t = t[start:]
+
+        # move the time axis in steps of a tenth of the window so the
+        # background only needs redrawing occasionally
+        full = self.background is None
+        xmin, xmax = self.axes[0].get_xlim()
+        if tnow > xmax:
+            xmax = tnow + 0.1*self.twindow
+            for axis in self.axes:
+                axis.set_xlim(xmax - self.twindow, xmax)
+            full = True
+
+        for axis, fields in zip(self.axes, self.layout):
+            width = max(int(axis.bbox.width), 1)
+            ylo, yhi = np.inf, -np.inf
+            for field in fields:
+                y = np.asarray(self.historian.logdict[field], dtype=float)[start:]
+                tk, yk = minmax(t, y, 2*width) if self.decimate else (t, y)
+                self.lines[field].set_data(tk, yk)
+                finite = yk[np.isfinite(yk)]
+                if len(finite):
+                    ylo, yhi = min(ylo, finite.min()), max(yhi, finite.max())
+            if ylo > yhi:
+                continue
+            lo, hi = axis.get_ylim()
+            if full or ylo < lo or yhi > hi:
+                margin = 0.05*(yhi - ylo) or 0.5
+                axis.set_ylim(ylo - margin, yhi + margin)
+                full = True
+
+        if self.blit:
+            canvas = self.fig.canvas
+            if full:
+                canvas.draw()
+                self.background = canvas.copy_from_bbox(self.fig.bbox)
+            else:
+                canvas.restore_region(self.background)
+            for line in self.lines.values():
+                line.axes.draw_artist(line)
+            canvas.blit(self.fig.bbox)
+            canvas.flush_events()
+        elif self.interactive:
+            self.background = True
+            self.fig.canvas.draw()
+            self.fig.canvas.flush_events()
+        else:
+            # displaying the figure renders it, so skip canvas.draw()
+            self.background = True
+            self.display.clear_output(wait=True)
+            self.display.display(self.fig)
+
+        self.last_plot_update = time.time()
+        self.last_plotted_time = tnow
+
+
+class LogWriter:
+    """Arrow IPC or Parquet file written in batches of samples
+
+    Each call to write() appends one record batch to an Arrow IPC file, or
+    one row group to a Parquet file, so a log can be archived while it is
+    recorded. The file can be read with read_log() once the writer is
+    closed.
+    """
+    def __init__(self, filename, columns, dtype='float64', compression='zstd'):
+        """
+        filename: a .parquet file, otherwise an Arrow IPC (.arrow, .feather)
+                file, which is uncompressed so read_log() can memory-map it
+        columns: list of column names
+        dtype: type used for all columns other than Time, which is always
+                float64
+        compression: Parquet compression codec
+        """
+        import pyarrow as pa
+
+        self.dtypes = [np.dtype(float if c == 'Time' else dtype) for c in columns]
+        self.schema = pa.schema([(c, pa.from_numpy_dtype(d))
+                                 for c, d in zip(columns, self.dtypes)])
+        if filename.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(filename, self.schema,
+                                           compression=compression)
+        else:
+            self.writer = pa.ipc.new_file(filename, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, arrays):
+        """Append a dictionary of equal length arrays keyed by column name"""
+        import pyarrow as pa
+
+        batch = pa.record_batch([pa.array(np.asarray(arrays[name], dtype=d))
+                                 for name, d in zip(self.schema.names, self.dtypes)],
+                                schema=self.schema)
+        self.writer.write_batch(batch)
+
+    def close(self):
+        """Finish the file"""
+        self.writer.close()
+
+
+def read_log(filename, columns=None):
+    """Read a log written by Historian.to_arrow(), Historian.to_parquet() or
+    a LogWriter
+
+    Arrow files are memory-mapped, so the returned arrays are views of the
+    file contents and no data is copied until it is used. Parquet files are
+    decoded into memory.
+
+    :param filename: A .parquet file, or an Arrow IPC (.arrow, .feather) file.
+    :param columns: List of columns to read, by default all.
+    :return: Dictionary of NumPy arrays keyed by column name, indexed like
+             Historian.logdict.
+
+    >>> log = read_log("data/run.arrow")
+    >>> plt.plot(log['Time'], log['T1'])
+    """
+    import pyarrow as pa
+
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(filename, columns=columns, memory_map=True)
+    else:
+        table = pa.ipc.open_file(pa.memory_map(filename)).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    return dict((name, table.column(name).to_numpy())
+                for name in table.column_names)
+
+
+if __name__ == "__main__":
+    import sys
+    usage = ("usage: historian.py migrate DBFILE [DBFILE ...]\n"
+             "       historian.py ingest [--minutes-in-month] DBFILE "
+             "DIRECTORY|CSVFILE ...")
+    if len(sys.argv) < 3 or sys.argv[1] not in ("migrate", "ingest"):
+        sys.exit(usage)
+    if sys.argv[1] == "migrate":
+        for filename in sys.argv[2:]:
+            migrate(filename)
+    else:
+        args = sys.argv[2:]
+        minutes_in_month = "--minutes-in-month" in args
+        if minutes_in_month:
+            args.remove("--minutes-in-month")
+        if len(args) < 2:
+            sys.exit(usage)
+        paths = args[1:]
+        files = ingest(paths[0] if len(paths) == 1 else paths, args[0],
+                       minutes_in_month=minutes_in_month)
+        print("{} files in {}".format(len(files), args[0]))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Drop-in replacements for tclab.setup, tclab.clock and tclab.Plotter for
+running simulated experiments in batch.
+
+Experiment functions written for the notebooks can be reused unchanged in
+parameter sweeps by importing these names in place of the tclab ones:
+
+    >>> import sys; sys.path.append('code')
+    >>> from simulation import setup, clock, Historian, Plotter
+
+In headless mode, selected with ``setup(..., headless=True)`` or by setting
+the environment variable ``TCLAB_HEADLESS=1``, the Plotter draws nothing and
+clock() advances simulated time without sleeping. ``speedup=float('inf')``
+runs in the same virtual time while still plotting, with a frame for every
+maxskip seconds of simulated time and one for the final samples.
+"""
+
+import contextlib
+import io
+import os
+import random
+
+import numpy as np
+import tclab
+from tclab.labtime import labtime
+from tclab.tclab import clip
+
+from historian import Historian
+from statespace import zoh
+import historian
+
+
+# mode selected by the last call to setup()
+settings = {'headless': False, 'virtual': False}
+
+
+class VirtualTCLabModel(tclab.TCLabModel):
+    """TCLabModel integrated exactly from one update to the next
+
+    Between updates the heater inputs are constant and the model equations
+    are linear, so the states are advanced with the zero-order-hold
+    discretization of the model, computed once for each distinct time step,
+    rather than by Euler steps of at most maxstep seconds.
+    """
+    # model equations for x = [H1, H2, T1, T2] driven by the heat input w
+    A = np.array([[-1/20 - 1/100, 1/100, 0, 0],
+                  [1/100, -1/20 - 1/100, 0, 0],
+                  [1/140, 0, -1/140, 0],
+                  [0, 1/140, 0, -1/140]])
+    B = np.array([[1, 0], [0, 1], [0, 0], [0, 0]])
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tlast = 0
+        self.discretizations = {}
+
+    def discretize(self, dt):
+        """Return the matrices (Ad, Bd) advancing the model by dt seconds"""
+        key = round(dt, 9)
+        if key not in self.discretizations:
+            self.discretizations[key] = zoh(self.A, self.B, dt)
+        return self.discretizations[key]
+
+    def update(self, t=None):
+        if t is None:
+            if self.synced:
+                self.tnow = labtime.time() - self.tstart
+            else:
+                return
+        else:
+            self.tnow = t
+
+        dt = self.tnow - self.tlast
+        if dt > 0:
+            Ad, Bd = self.discretize(dt)
+            x = np.array([self._H1, self._H2, self._T1, self._T2])
+            w = np.array([self._P1*self._Q1/5720 + self.Ta/20,
+                          self._P2*self._Q2/5720 + self.Ta/20])
+            self._H1, self._H2, self._T1, self._T2 = (Ad @ x + Bd @ w).tolist()
+            self.tlast = self.tnow
+
+
+class QuietTCLabModel(VirtualTCLabModel):
+    """VirtualTCLabModel that does not print connection messages"""
+    def __init__(self, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            super().__init__(*args, **kwargs)
+
+    def close(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            super().close()
+
+
+def setup(connected=True, speedup=1, headless=None):
+    """Set up a lab session, see tclab.setup
+
+    speedup: ratio of lab time to real time. speedup=float('inf') runs a
+        simulation in virtual time: clock() advances without sleeping and
+        the model is integrated exactly to each tick.
+    headless: if True, Plotter draws nothing and, when not connected, the
+        simulation runs in virtual time with a model that prints no
+        messages. By default the TCLAB_HEADLESS environment variable is used.
+
+    >>> TCLab = setup(connected=False, speedup=float('inf'))
+    """
+    if headless is None:
+        headless = os.environ.get('TCLAB_HEADLESS', '0') not in ('', '0')
+    if connected and speedup == float('inf'):
+        raise ValueError('The real lab must run in real time')
+    settings['headless'] = headless
+    settings['virtual'] = not connected and (headless or speedup == float('inf'))
+    if settings['virtual']:
+        return QuietTCLabModel if headless else VirtualTCLabModel
+    return tclab.setup(connected, speedup)
+
+
+def clock(period, step=1, tol=float('inf'), adaptive=True):
+    """Generator providing time values, see tclab.clock
+
+    In headless simulations labtime is stopped and set to each tick in turn,
+    so the model advances exactly one step per iteration and no time is
+    spent sleeping. When the clock finishes, labtime is restarted and any
+    Plotter with samples not yet drawn is redrawn.
+    """
+    if not settings['virtual']:
+        try:
+            yield from tclab.clock(period, step, tol, adaptive)
+        finally:
+            historian.draw_pending()
+        return
+
+    running = labtime.running
+    labtime.stop()
+    start = labtime.time()
+    k = 0
+    now = 0
+    try:
+        while round(now, 0) <= period:
+            labtime.reset(start + now)
+            yield round(now, 2)
+            if round(now) >= period:
+                break
+            k += 1
+            now = k*step
+    finally:
+        if running:
+            labtime.start()
+        historian.draw_pending()
+
+
+class TCLabFleet:
+    """Simulator for many identical TCLab boards stepped together
+
+    The states of all boards are held in one (n, 4) array and advanced with
+    a single matrix product per time step using the same exact
+    discretization as VirtualTCLabModel. Arrays of all measurements and
+    inputs are available as fleet.T1, fleet.Q1(), ..., and fleet[i] is a
+    view of board i with the attributes of TCLabModel, so the generator
+    controllers in the notebooks can be used with each board unchanged.
+
+    >>> with TCLabFleet(100) as fleet:
+    ...     controllers = [PI(2, 0.1) for lab in fleet]
+    ...     for t in clock(600, 2):
+    ...         fleet.update(t)
+    ...         for lab, pi in zip(fleet, controllers):
+    ...             lab.Q1(pi.send((2, 40, lab.T1, lab.Q1())))
+    """
+    A = VirtualTCLabModel.A
+    B = VirtualTCLabModel.B
+
+    def __init__(self, n, Ta=21, P1=200, P2=100, synced=False):
+        """
+        n: number of boards
+        Ta: ambient temperature, a scalar or one value for each board
+        P1, P2: maximum heater powers, scalars or one value for each board
+        synced: if True, advance to labtime whenever a value is read, as
+                TCLabModel does. Otherwise time advances only in update(t).
+        """
+        self.n = n
+        self.synced = synced
+        self.Ta = np.broadcast_to(np.asarray(Ta, dtype=float), (n,)).copy()
+        self.P = np.column_stack([np.broadcast_to(P1, (n,)),
+                                  np.broadcast_to(P2, (n,))]).astype(float)
+        self.x = np.repeat(self.Ta[:, None], 4, axis=1)   # H1, H2, T1, T2
+        self.Q = np.zeros((n, 2))
+        self.tstart = labtime.time()
+        self.tnow = 0
+        self.tlast = 0
+        self.discretizations = {}
+        self.boards = [FleetBoard(self, i) for i in range(n)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return self.boards[i]
+
+    def __iter__(self):
+        return iter(self.boards)
+
+    def close(self):
+        """Turn off all heaters"""
+        self.Q[:] = 0
+
+    def discretize(self, dt):
+        """Return the matrices (Ad, Bd) advancing the model by dt seconds"""
+        key = round(dt, 9)
+        if key not in self.discretizations:
+            self.discretizations[key] = zoh(self.A, self.B, dt)
+        return self.discretizations[key]
+
+    def update(self, t=None):
+        """Advance all boards to time t, or to labtime if synced"""
+        if t is None:
+            if not self.synced:
+                return
+            t = labtime.time() - self.tstart
+        self.tnow = t
+        dt = self.tnow - self.tlast
+        if dt > 0:
+            Ad, Bd = self.discretize(dt)
+            w = self.P*self.Q/5720 + self.Ta[:, None]/20
+            self.x = self.x @ Ad.T + w @ Bd.T
+            self.tlast = self.tnow
+
+    def measurement(self, T):
+        """Add sensor noise and A/D quantization to an array of temperatures"""
+        T = T + np.random.normal(0, 0.043, T.shape)
+        return np.clip(T - T % 0.3223, -50, 132.2)
+
+    @property
+    def T1(self):
+        """Array of temperatures T1 of all boards"""
+        self.update()
+        return self.measurement(self.x[:, 2])
+
+    @property
+    def T2(self):
+        """Array of temperatures T2 of all boards"""
+        self.update()
+        return self.measurement(self.x[:, 3])
+
+    def Q1(self, val=None):
+        """Get or set heater powers Q1 of all boards, clipped to 0-100"""
+        self.update()
+        if val is not None:
+            self.Q[:, 0] = np.clip(val, 0, 100)
+        return self.Q[:, 0].copy()
+
+    def Q2(self, val=None):
+        """Get or set heater powers Q2 of all boards, clipped to 0-100"""
+        self.update()
+        if val is not None:
+            self.Q[:, 1] = np.clip(val, 0, 100)
+        return self.Q[:, 1].copy()
+
+
+class FleetBoard:
+    """View of one board of a TCLabFleet with the interface of TCLabModel"""
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.index = index
+        self.sources = [('T1', self.scan),
+                        ('T2', None),
+                        ('Q1', None),
+                        ('Q2', None),
+                        ]
+
+    def measurement(self, T):
+        T = T + random.normalvariate(0, 0.043)
+        return max(-50, min(132.2, T - T % 0.3223))
+
+    @property
+    def T1(self):
+        """Return a float denoting temperature T1 of this board in degrees C."""
+        self.fleet.update()
+        return self.measurement(self.fleet.x[self.index, 2])
+
+    @property
+    def T2(self):
+        """Return a float denoting temperature T2 of this board in degrees C."""
+        self.fleet.update()
+        return self.measurement(self.fleet.x[self.index, 3])
+
+    def Q1(self, val=None):
+        """Get or set heater power Q1 of this board, clipped to 0-100"""
+        self.fleet.update()
+        if val is not None:
+            self.fleet.Q[self.index, 0] = clip(val)
+        return self.fleet.Q[self.index, 0]
+
+    def Q2(self, val=None):
+        """Get or set heater power Q2 of this board, clipped to 0-100"""
+        self.fleet.update()
+        if val is not None:
+            self.fleet.Q[self.index, 1] = clip(val)
+        return self.fleet.Q[self.index, 1]
+
+    def scan(self):
+        return (self.T1, self.T2, self.Q1(), self.Q2())
+
+    U1 = property(fget=Q1, fset=Q1, doc="Heater 1 value")
+    U2 = property(fget=Q2, fset=Q2, doc="Heater 2 value")
+
+
+class Plotter(historian.Plotter):
+    """Plotter that only updates the historian in headless mode"""
+    def __init__(self, historian, twindow=120, layout=None, **kwargs):
+        self.historian = historian
+        self.headless = settings['headless']
+        if not self.headless:
+            super().__init__(historian, twindow, layout, **kwargs)
+
+    def update(self, tnow=None):
+        if self.headless:
+            self.historian.update(tnow)
+        else:
+            super().update(tnow)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Persistent solver sessions and pools of warm solver processes for Pyomo.
+
+The Pyomo notebooks call SolverFactory('ipopt').solve(m) or
+SolverFactory('cbc').solve(m) for every model, which writes the model to an
+.nl or .lp file, starts a solver process and reads back a results file.
+This module keeps solvers between solves instead:
+
+- session() returns a solver that is created once per process and name.
+  Ipopt uses Pyomo's persistent APPSI interface, which keeps the model's
+  symbolic representation and only writes what changed. Cbc uses the
+  persistent APPSI interface too. LP and MILP problems for highs, or for
+  cbc and glpk when asked with highs=True, are passed in memory to HiGHS
+  when highspy is installed, with no files or processes at all.
+- SolverPool starts worker processes that each build a model once, with
+  the swept values as mutable Params, and re-solve it for each set of
+  values from the previous solution.
+
+    >>> import sys; sys.path.append('code')
+    >>> from solvers import SolverPool, session, solve
+    >>> solve(session('cbc'), m)
+    >>> with SolverPool(p_milk_model, 'cbc', highs=True) as pool:
+    ...     profits = pool.map([{'f': f} for f in np.linspace(0.03, 0.051, 100)])
+
+The build function given to SolverPool must be picklable, for example a
+function defined in a module or, where processes are forked, in the
+notebook.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import warnings
+
+# LP and MILP solvers handled by linear_solver()
+LINEAR = ('cbc', 'glpk', 'highs', 'appsi_highs')
+
+
+def ipopt_solver(executable=None, options=None, fixed_structure=True):
+    """Return an ipopt interface that keeps the model between solves
+
+    Pyomo's APPSI interface is used when its compiled extensions are
+    available (see ``pyomo build-extensions``). It writes the model's
+    symbolic representation once and afterwards only updates what changed
+    and the initial point. Otherwise the standard interface is returned,
+    which rewrites the model on each solve.
+
+    executable: path to the ipopt executable, by default found on the PATH
+    options: dictionary of ipopt options
+    fixed_structure: if True, only changes to mutable Params are looked for
+                     between solves of the same model, which is cheapest
+                     for models that are built once and re-solved
+    """
+    from pyomo.environ import SolverFactory
+    from pyomo.contrib.appsi import cmodel
+    from pyomo.contrib.appsi.solvers import Ipopt
+
+    if cmodel.cmodel_available:
+        solver = Ipopt()
+        if executable is not None:
+            from pyomo.common import Executable
+            solver.config.executable = Executable(executable)
+        if solver.available():
+            solver.ipopt_options.update(options or {})
+            solver.config.load_solution = False
+            if fixed_structure:
+                update = solver.update_config
+                update.check_for_new_or_removed_constraints = False
+                update.check_for_new_or_removed_vars = False
+                update.check_for_new_or_removed_params = False
+                update.check_for_new_objective = False
+                update.update_constraints = False
+                update.update_vars = False
+                update.update_named_expressions = False
+                update.update_objective = False
+            return solver
+    solver = SolverFactory('ipopt', executable=executable)
+    solver.options.update(options or {})
+    return solver
+
+
+def linear_solver(name='cbc', executable=None, options=None, highs=False):
+    """Return an LP and MILP solver that keeps the model between solves
+
+    For 'highs', Pyomo's persistent HiGHS interface is returned when highspy
+    is installed. It holds the model in the solver's memory and passes only
+    the changes on later solves, so no files are written and no processes
+    are started. For 'cbc' the persistent APPSI interface of cbc is used
+    when available. Otherwise SolverFactory(name) is returned.
+
+    name: the solver the notebook uses, such as 'cbc' or 'glpk'
+    executable: path to the executable of that solver
+    options: dictionary of options for that solver
+    highs: if True, use HiGHS in place of cbc or glpk. The results may
+           differ where a problem has several optimal solutions. Options
+           for cbc and glpk mean nothing to HiGHS, so if options are given
+           the named solver is used with a warning.
+    """
+    from pyomo.environ import SolverFactory
+    from pyomo.contrib.appsi.solvers import Cbc, Highs
+
+    if highs and options and name not in ('highs', 'appsi_highs'):
+        warnings.warn(f'{name} is used rather than HiGHS because options '
+                      f'for {name} were given')
+        highs = False
+    if highs or name in ('highs', 'appsi_highs'):
+        solver = Highs()
+        if solver.available():
+            if name in ('highs', 'appsi_highs'):
+                solver.highs_options.update(options or {})
+            solver.config.load_solution = False
+            return solver
+    if name == 'cbc':
+        solver = Cbc()
+        if executable is not None:
+            from pyomo.common import Executable
+            solver.config.executable = Executable(executable)
+        if solver.available():
+            solver.cbc_options.update(options or {})
+            solver.config.load_solution = False
+            return solver
+    solver = SolverFactory(name, executable=executable)
+    solver.options.update(options or {})
+    return solver
+
+
+_sessions = {}
+
+
+def session(name='ipopt', executable=None, options=None, **kwargs):
+    """Return the solver for name created once in this process
+
+    Ipopt comes from ipopt_solver() with fixed_structure=False, so the same
+    session can solve models that change, and the names in LINEAR from
+    linear_solver(). Other names are passed to SolverFactory. kwargs are
+    passed to ipopt_solver() or linear_solver().
+    """
+    key = (name, executable, tuple(sorted((options or {}).items())),
+           tuple(sorted(kwargs.items())))
+    if key not in _sessions:
+        if name == 'ipopt':
+            kwargs.setdefault('fixed_structure', False)
+            _sessions[key] = ipopt_solver(executable, options, **kwargs)
+        elif name in LINEAR:
+            _sessions[key] = linear_solver(name, executable, options, **kwargs)
+        else:
+            from pyomo.environ import SolverFactory
+
+            _sessions[key] = SolverFactory(name, executable=executable)
+            _sessions[key].options.update(options or {})
+    return _sessions[key]
+
+
+def solve(solver, model):
+    """Solve model with a solver from this module and load the solution
+
+    Returns True if the solution is optimal.
+    """
+    from pyomo.contrib.appsi.base import PersistentSolver, TerminationCondition
+
+    if isinstance(solver, PersistentSolver):
+        results = solver.solve(model)
+        if results.best_feasible_objective is not None:
+            results.solution_loader.load_vars()
+        return results.termination_condition == TerminationCondition.optimal
+    results = solver.solve(model, load_solutions=False)
+    if len(results.solution) == 0:
+        return False
+    model.solutions.load_from(results)
+    return str(results.solver.termination_condition) == 'optimal'
+
+
+def assign(model, values):
+    """Set components of model by name from a dictionary
+
+    Params are set and Vars fixed to the values, which are scalars or, for
+    indexed components, dictionaries of values by index.
+    """
+    from pyomo.environ import Var
+
+    for name, value in values.items():
+        component = model.find_component(name)
+        if component is None:
+            raise KeyError(f'{name} is not a component of the model')
+        items = value.items() if isinstance(value, dict) else [(None, value)]
+        for index, item in items:
+            data = component[index]
+            if data.ctype is Var:
+                data.fix(item)
+            else:
+                data.set_value(item)
+
+
+def objective(model):
+    """Return the value of the active objective of model"""
+    from pyomo.environ import Objective, value
+
+    return value(next(model.component_data_objects(Objective, active=True)))
+
+
+_worker = {}
+
+
+def _init_worker(build, name, extract, kwargs):
+    _worker.update(model=build(), solver=session(name, **kwargs), extract=extract)
+
+
+def _solve_values(values):
+    model = _worker['model']
+    assign(model, values)
+    if not solve(_worker['solver'], model):
+        return None
+    return _worker['extract'](model)
+
+
+class SolverPool:
+    """Worker processes that each build a model once and re-solve it
+
+    Each process builds the model with build() when it starts and keeps a
+    session() of the solver. map() sends each set of values to a process,
+    which assigns them with assign(), solves from the previous solution in
+    that process and returns extract(model), or None if the solve failed.
+    The processes stay alive between calls to map() until the pool is
+    closed.
+    """
+    def __init__(self, build, name='ipopt', processes=None, extract=objective,
+                 **kwargs):
+        """
+        build: function without arguments returning a ConcreteModel with
+               the values to change as mutable Params or as Vars to fix
+        name: the solver, as for session()
+        processes: number of worker processes, by default one per CPU
+        extract: function of the solved model returning a picklable result
+        kwargs: passed to session()
+        """
+        self.processes = processes or os.cpu_count()
+        self.executor = ProcessPoolExecutor(self.processes, initializer=_init_worker,
+                                            initargs=(build, name, extract, kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def map(self, values, chunksize=None):
+        """Return the results of solving for each dictionary in values
+
+        Neighbouring values are sent to the same process in chunks, so each
+        solve starts close to the previous solution.
+        """
+        values = list(values)
+        if chunksize is None:
+            chunksize = max(1, -(-len(values)//self.processes))
+        return list(self.executor.map(_solve_values, values, chunksize=chunksize))
+
+    def close(self):
+        """Stop the worker processes"""
+        self.executor.shutdown()
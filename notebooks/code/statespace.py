@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Exact discretization of the linear TCLab state space models.
+
+The models in the notebooks have the form
+
+    dx/dt = A x + Bu u + Bd d
+        y = C x
+
+and are stepped forward with Euler's method, x + dt*(A@x + Bu@u + Bd@d),
+which needs small time steps to stay accurate. With u and d held constant
+over each step (zero-order hold) the solution is exact:
+
+    x[k+1] = Ad x[k] + Bud u[k] + Bdd d[k]
+
+where Ad, Bud and Bdd are blocks of the matrix exponential of the augmented
+matrix [[A, Bu, Bd], [0, 0, 0]]*dt. LTIModel computes these matrices once for
+each distinct time step and reuses them.
+
+    >>> import sys; sys.path.append('code')
+    >>> from statespace import LTIModel, model_generator, observer
+    >>> model = LTIModel(A, Bu, Bd, C)
+    >>> x = model.step(x, u, d, dt=10)
+"""
+
+import numpy as np
+from scipy.linalg import expm
+
+
+def zoh(A, B, dt):
+    """Return the zero-order-hold discretization (Ad, Bd) of dx/dt = Ax + Bu"""
+    n, m = B.shape
+    M = np.zeros([n + m, n + m])
+    M[:n, :n] = A
+    M[:n, n:] = B
+    E = expm(M*dt)
+    return E[:n, :n], E[:n, n:]
+
+
+class LTIModel:
+    """Linear state space model with cached exact discretizations"""
+    def __init__(self, A, Bu, Bd=None, C=None):
+        """
+        A: (n, n) state matrix
+        Bu: (n, m) input matrix for manipulated variables
+        Bd: (n, p) input matrix for disturbances, or None
+        C: (q, n) output matrix, or None for y = x
+        """
+        self.A = np.atleast_2d(np.asarray(A, dtype=float))
+        n = self.A.shape[0]
+        self.Bu = np.asarray(Bu, dtype=float).reshape(n, -1)
+        self.Bd = (np.zeros((n, 0)) if Bd is None else
+                   np.asarray(Bd, dtype=float).reshape(n, -1))
+        self.C = np.eye(n) if C is None else np.atleast_2d(np.asarray(C, dtype=float))
+        self.n = n
+        self.m = self.Bu.shape[1]
+        self.p = self.Bd.shape[1]
+        self.discretizations = {}
+
+    def discretize(self, dt):
+        """Return (Ad, Bud, Bdd) advancing the state by dt seconds"""
+        key = round(dt, 9)
+        if key not in self.discretizations:
+            Ad, B = zoh(self.A, np.hstack([self.Bu, self.Bd]), dt)
+            self.discretizations[key] = Ad, B[:, :self.m], B[:, self.m:]
+        return self.discretizations[key]
+
+    def step(self, x, u, d=(), dt=1):
+        """Return the state dt seconds after x with inputs u and d held constant"""
+        Ad, Bud, Bdd = self.discretize(dt)
+        x = Ad @ x + Bud @ np.atleast_1d(u)
+        if self.p:
+            x = x + Bdd @ np.atleast_1d(d)
+        return x
+
+    def output(self, x):
+        """Return the measured outputs y = C x"""
+        return self.C @ x
+
+    def simulate(self, x0, u, d=None, dt=1):
+        """Return the states at each step of an input sequence
+
+        x0: initial state
+        u: (N, m) array of inputs, or (N,) for a single input
+        d: (N, p) array of disturbances, a constant disturbance vector, or
+           None if the model has no disturbance inputs
+        dt: time step
+
+        Returns an (N + 1, n) array of states starting with x0.
+        """
+        Ad, Bud, Bdd = self.discretize(dt)
+        u = np.asarray(u, dtype=float).reshape(len(u), -1)
+        if self.p:
+            d = np.broadcast_to(np.asarray(d, dtype=float).reshape(-1, self.p),
+                                (len(u), self.p))
+            w = u @ Bud.T + d @ Bdd.T
+        else:
+            w = u @ Bud.T
+        x = np.zeros((len(u) + 1, self.n))
+        x[0] = x0
+        for k in range(len(u)):
+            x[k + 1] = Ad @ x[k] + w[k]
+        return x
+
+
+def model_generator(model, x_initial, d=()):
+    """Generator simulating a model in parallel with an experiment
+
+    Yields the current state, then receives [t, u] with the next time and
+    the input applied since the last time, like tclab_model() in
+    04.03-State-Estimation.
+    """
+    t_now = 0
+    x_now = np.asarray(x_initial, dtype=float)
+    while True:
+        t_next, u = yield x_now
+        x_now = model.step(x_now, u, d, t_next - t_now)
+        t_now = t_next
+
+
+def observer(model, L, x_initial, d_hat=()):
+    """Luenberger observer using exact discretization
+
+    Yields the state estimate and the prediction error y_pred - y, then
+    receives [t, u, y], like tclab_observer() in
+    04.06-Lab-Assignment-Anomaly-Detection. Between measurements the
+    continuous observer dx/dt = (A - LC) x + Bu u + Bd d + L y is integrated
+    exactly, so the time step can be much larger than with Euler updates.
+    """
+    L = np.asarray(L, dtype=float).reshape(model.n, -1)
+    closed = LTIModel(model.A - L @ model.C, model.Bu,
+                      np.hstack([model.Bd, L]), model.C)
+    d_hat = np.atleast_1d(np.asarray(d_hat, dtype=float))
+    t = 0
+    x_hat = np.asarray(x_initial, dtype=float)
+    y_err = None
+    while True:
+        t_prev = t
+        t, u, y = yield x_hat, y_err
+        y = np.atleast_1d(y)
+        y_err = model.output(model.step(x_hat, u, d_hat, t - t_prev)) - y
+        x_hat = closed.step(x_hat, u, np.concatenate([d_hat, y]), t - t_prev)